@@ -1,4 +1,12 @@
+import cache
+import cluster
+import dither
 import handlers
 import magick
+import monitor
+import scheduler
+import server
+import stats
 
-__all__ = ["handlers", "magick"]
+__all__ = ["cache", "cluster", "dither", "handlers", "magick", "monitor", "scheduler", "server",
+           "stats"]
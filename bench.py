@@ -0,0 +1,247 @@
+"""
+Benchmarks and output checks of the convert pipeline.
+
+Each query string is turned into an ImageMagick chain by ImageHandler's
+calculate_options and rendered against a local source.
+
+In cpu mode (the default) it's rendered once with the current pipeline and
+once with thumbnail mode, and the CPU time convert used (user + sys, from
+wait4) is reported for both:
+
+    python bench.py --source=images/hulu.jpg --repeat=5 "size=200x96" ...
+
+In compare mode it's rendered by a reference backend, the plain convert
+command line, and by a candidate backend, by default the pipeline with every
+optimization on.  Outputs are compared with ImageMagick's compare (RMSE,
+normalized to 0..1) and the latency of each backend is reported.  The exit
+status is 1 if any output differs by more than the threshold:
+
+    python bench.py --mode=compare --threshold=0.01 "size=200x96" ...
+
+A backend is any callable taking (source, query) and returning the image;
+--candidate=package.module:function tests one outside this module.  E.g.
+NumPy dithering of png16 against -remap (dithering noise differs, hence the
+looser threshold):
+
+    python bench.py --mode=compare --threshold=0.05 \
+        --candidate=ectyper.bench:ordered_dither_backend "format=png16"
+"""
+from ectyper.handlers import ImageHandler
+import os
+from subprocess import Popen, PIPE
+import sys
+import tempfile
+from time import time
+from tornado import web
+from tornado.httputil import HTTPServerRequest
+from tornado.options import define, options, parse_command_line
+
+
+class _NullConnection(object):
+    """
+    Stands in for the HTTP connection of requests that are never served.
+    """
+
+    def set_close_callback(self, callback):
+        pass
+
+
+def build_magick(query, handler_class=ImageHandler, path="/bench"):
+    """
+    Returns the ImageMagick chain handler_class calculates for a request to
+    path with the given query string.
+    """
+    request = HTTPServerRequest(method="GET", uri="%s?%s" % (path, query),
+                                connection=_NullConnection())
+    handler = handler_class(web.Application(), request)
+    handler.calculate_options()
+    return handler.magick
+
+
+def cpu_time(magick):
+    """
+    Returns the user + sys seconds used by the last conversion of magick.
+    """
+    if not magick.rusage:
+        return None
+    return magick.rusage.ru_utime + magick.rusage.ru_stime
+
+
+def render(source, query, thumbnail_factor=None, thumbnail_filter=None):
+    """
+    Renders source according to query, returns (cpu seconds, output bytes).
+    """
+    magick = build_magick(query)
+    if thumbnail_factor:
+        magick.thumbnail_factor = thumbnail_factor
+        magick.thumbnail_filter = thumbnail_filter
+        magick.plan(magick.probe(source))
+
+    output = magick.convert(source)
+    return (cpu_time(magick), len(output) if output else 0)
+
+
+def pipeline_backend(optimize=True, probe=True, thumbnail_factor=None, thumbnail_filter=None,
+                     dither_method=None):
+    """
+    Returns a backend rendering through ImageMagick.convert.  optimize runs
+    the command line optimizer; probe plans the chain against the source
+    and serves sources the chain wouldn't change untouched, like
+    ImageHandler.PROBE_SOURCES, with thumbnail mode if thumbnail_factor is
+    given.  dither_method is used as ImageHandler.DITHER_METHOD.
+    """
+    handler_class = type("BenchHandler", (ImageHandler,), {"DITHER_METHOD": dither_method})
+
+    def _render(source, query):
+        magick = build_magick(query, handler_class)
+        magick.optimize = optimize
+        if probe:
+            magick.thumbnail_factor = thumbnail_factor
+            magick.thumbnail_filter = thumbnail_filter
+            info = magick.probe(source)
+            magick.plan(info)
+            if magick.is_identity(info):
+                fh = open(source, 'rb')
+                try:
+                    return fh.read()
+                finally:
+                    fh.close()
+        return magick.convert(source)
+    return _render
+
+
+reference_backend = pipeline_backend(optimize=False, probe=False)
+
+# format=png16 dithered by NumPy rather than -remap
+ordered_dither_backend = pipeline_backend(optimize=False, probe=False, dither_method="ordered")
+diffuse_dither_backend = pipeline_backend(optimize=False, probe=False, dither_method="diffuse")
+
+
+def load_backend(name):
+    """
+    Returns the backend called "package.module:function".
+    """
+    (module, function) = name.split(":", 1)
+    return getattr(__import__(module, fromlist=[function]), function)
+
+
+def compare_images(a, b, compare_path=None):
+    """
+    Returns the normalized (0..1) RMSE between the images a and b, given as
+    strings, or None if they can't be compared (i.e. different sizes).
+    """
+    if a == b:
+        return 0.0
+    if not a or not b:
+        return None
+
+    paths = []
+    try:
+        for data in (a, b):
+            (fd, path) = tempfile.mkstemp(prefix="ectyper-bench-")
+            paths.append(path)
+            os.write(fd, data)
+            os.close(fd)
+
+        proc = Popen(['compare' if not compare_path else compare_path,
+                      '-metric', 'RMSE'] + paths + ['null:'],
+                     stdout=PIPE, stderr=PIPE, close_fds=True)
+        output = proc.communicate()[1]
+    finally:
+        for path in paths:
+            os.remove(path)
+
+    # "absolute (normalized)", exit status 1 just means they differ
+    if proc.returncode not in (0, 1) or '(' not in output:
+        return None
+    try:
+        return float(output[output.index('(') + 1:output.index(')')])
+    except ValueError:
+        return None
+
+
+def time_backend(backend, source, query, repeat):
+    """
+    Renders query repeat times with backend, returns (the seconds each
+    render took, the last output).
+    """
+    times = []
+    output = None
+    for _ in xrange(repeat):
+        start = time()
+        output = backend(source, query)
+        times.append(time() - start)
+    return (times, output)
+
+
+def _median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) / 2] if values else float('nan')
+
+
+def run_cpu(source, queries):
+    print "%-50s %12s %12s %8s" % ("query", "current ms", "thumb ms", "bytes")
+    for query in queries:
+        current = [render(source, query) for _ in xrange(options.repeat)]
+        thumb = [render(source, query, options.thumbnail_factor, options.thumbnail_filter)
+                 for _ in xrange(options.repeat)]
+        print "%-50s %12.1f %12.1f %8d" % (
+            query,
+            _median([c for (c, _) in current]) * 1000,
+            _median([c for (c, _) in thumb]) * 1000,
+            thumb[0][1])
+    return True
+
+
+def run_compare(source, queries):
+    if options.candidate:
+        candidate = load_backend(options.candidate)
+    else:
+        candidate = pipeline_backend(thumbnail_factor=options.thumbnail_factor,
+                                     thumbnail_filter=options.thumbnail_filter)
+
+    passed = True
+    print "%-50s %10s %10s %10s %10s %8s" % ("query", "ref ms", "cand ms", "cand/s", "rmse", "")
+    for query in queries:
+        (ref_times, expected) = time_backend(reference_backend, source, query, options.repeat)
+        (cand_times, actual) = time_backend(candidate, source, query, options.repeat)
+        rmse = compare_images(expected, actual, options.compare_path)
+        ok = rmse is not None and rmse <= options.threshold
+        passed = passed and ok
+        latency = _median(cand_times)
+        print "%-50s %10.1f %10.1f %10.1f %10s %8s" % (
+            query,
+            _median(ref_times) * 1000,
+            latency * 1000,
+            1 / latency if latency else float('nan'),
+            "%.5f" % rmse if rmse is not None else "-",
+            "ok" if ok else "FAIL")
+    return passed
+
+
+if __name__ == "__main__":
+    define("mode", type=str, default="cpu",
+           help="cpu: CPU time of the current pipeline and thumbnail mode, "
+                "compare: output and latency of a candidate backend against the reference")
+    define("source", type=str, default="images/hulu.jpg",
+           help="Local image to render")
+    define("repeat", type=int, default=5,
+           help="Renders per query string and mode, the median is reported")
+    define("thumbnail_factor", type=float, default=2.0,
+           help="Thumbnail mode reduction factor")
+    define("thumbnail_filter", type=str, default=None,
+           help="Thumbnail mode resampling filter")
+    define("candidate", type=str, default=None,
+           help="Backend to compare, as package.module:function")
+    define("threshold", type=float, default=0.01,
+           help="Largest normalized RMSE accepted in compare mode")
+    define("compare_path", type=str, default=None,
+           help="Path to ImageMagick's compare")
+    queries = parse_command_line()
+    source = os.path.abspath(options.source)
+
+    if options.mode == "compare":
+        passed = run_compare(source, queries)
+    else:
+        passed = run_cpu(source, queries)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,793 @@
+from binascii import crc32
+from collections import deque
+from errno import EEXIST
+from hashlib import md5
+import logging
+import mmap
+import os
+from Queue import Queue
+from random import randint
+import socket
+import struct
+from threading import Lock, Thread
+from time import time
+
+from ectyper import stats
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+
+__all__ = ["CacheStore", "MemcacheStore", "SegmentStore", "PinnedStore", "FileCacheWriter"]
+
+logger = logging.getLogger("ectyper")
+
+
+class CacheStore(object):
+    """
+    Interface of the key/value stores used by StoreCachingImageHandler.  All
+    methods are asynchronous and report through callbacks, which stores that
+    don't do I/O may call immediately.
+    """
+
+    def get(self, key, callback):
+        """
+        Calls callback with the value stored under key, or None if there is
+        none.
+        """
+        raise NotImplementedError()
+
+    def stat(self, key, callback):
+        """
+        Calls callback with (length, timestamp) of the value stored under
+        key, or None if there is none or the store can't tell without
+        reading the value.
+        """
+        callback(None)
+
+    def set(self, key, value, callback=None):
+        """
+        Stores value under key, then calls callback (if given) with True if
+        the value was stored.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key, callback=None):
+        """
+        Removes key, then calls callback (if given) with True if it existed.
+        """
+        raise NotImplementedError()
+
+
+class _ConnectionPool(object):
+    """
+    Pool of up to max_connections IOStreams to one server.  Commands run one
+    at a time per connection and queue up while all connections are busy.
+
+    Connections belong to the process and IOLoop that opened them: pools
+    are created before serve() forks, so a worker drops any connections
+    inherited from its parent and opens its own on the worker's IOLoop.
+    """
+
+    def __init__(self, address, max_connections, timeout, ioloop=None):
+        self.address = address
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.ioloop = ioloop
+        self.pid = os.getpid()
+        self.idle = []
+        self.connections = 0
+        self.waiting = deque()
+
+    def _ioloop(self):
+        return self.ioloop or IOLoop.current()
+
+    def _check_pid(self):
+        if self.pid == os.getpid():
+            return
+        # Forked: the sockets are shared with the parent, leave them to it
+        for stream in self.idle:
+            stream.socket.close()
+        self.pid = os.getpid()
+        self.idle = []
+        self.connections = 0
+        self.waiting = deque()
+
+    def run(self, command, callback):
+        """
+        Runs command(stream, done) on a connection.  command must call
+        done(result) once it has read its response; callback is then called
+        with the result, or with None if the connection failed or timed out.
+        """
+        self._check_pid()
+        while self.idle:
+            stream = self.idle.pop()
+            if not stream.closed():
+                self._start(stream, command, callback)
+                return
+            self.connections -= 1
+
+        if self.connections < self.max_connections:
+            self.connections += 1
+            stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            stream.connect(self.address)
+            self._start(stream, command, callback)
+        else:
+            self.waiting.append((command, callback))
+
+    def _start(self, stream, command, callback):
+        ioloop = self._ioloop()
+        state = {'finished': False}
+
+        def _finish(result, reusable):
+            if state['finished']:
+                return
+            state['finished'] = True
+            ioloop.remove_timeout(timeout)
+            stream.set_close_callback(None)
+            if reusable and not stream.closed():
+                self.idle.append(stream)
+            else:
+                stream.close()
+                self.connections -= 1
+            if self.waiting:
+                self.run(*self.waiting.popleft())
+            callback(result)
+
+        def _on_timeout():
+            logger.warning("Cache server %s:%d timed out" % self.address)
+            _finish(None, False)
+
+        timeout = ioloop.add_timeout(ioloop.time() + self.timeout, _on_timeout)
+        stream.set_close_callback(lambda: _finish(None, False))
+        try:
+            command(stream, lambda result: _finish(result, True))
+        except (StreamClosedError, socket.error):
+            _finish(None, False)
+
+
+def _read_values(stream, done):
+    """
+    Reads the response to a memcached get command, calls done with a dict of
+    key -> (flags, data).
+    """
+    values = {}
+
+    def _on_line(line):
+        fields = line.split()
+        if fields == ['END']:
+            done(values)
+        elif len(fields) == 4 and fields[0] == 'VALUE':
+            (key, flags, length) = (fields[1], int(fields[2]), int(fields[3]))
+            stream.read_bytes(length + 2, lambda data: _on_data(key, flags, data))
+        else:
+            logger.error("Unexpected cache response: %r" % line)
+            stream.close()
+
+    def _on_data(key, flags, data):
+        values[key] = (flags, data[:-2])
+        stream.read_until('\r\n', _on_line)
+
+    stream.read_until('\r\n', _on_line)
+
+
+class MemcacheStore(CacheStore):
+    """
+    CacheStore on memcached servers, or anything else that speaks the
+    memcached text protocol, so every node of a fleet shares one cache.
+
+    Keys are hashed (md5) and spread over the servers by crc32, each server
+    gets a pool of up to max_connections connections.  Values larger than
+    chunk_size are split over several items: the first item's flags hold the
+    number of chunks, its data starts with a "(token) (length)" line, and the
+    rest are stored under "(key):(token):(n)" on the same server.  Every
+    write picks a new token, so a reader never joins a head to the parts of
+    another write; the length catches parts that were evicted and stored
+    again.
+    """
+
+    # Stay below memcached's default 1MB item size limit
+    CHUNK_SIZE = 1000 * 1000
+
+    def __init__(self, servers, max_connections=8, expire=0, timeout=1.0,
+                 prefix="ectyper:", chunk_size=None, ioloop=None):
+        """
+        servers is a list of "host:port" strings, expire the expiration time
+        of stored values in seconds (0 for none) and timeout the number of
+        seconds to wait for a command to complete.  Commands run on ioloop,
+        by default the current IOLoop when they're issued, so stores can be
+        created at import time, before serve() forks its workers.
+        """
+        self.ioloop = ioloop
+        self.expire = expire
+        self.prefix = prefix
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.pools = []
+        for server in servers:
+            (host, port) = server.rsplit(":", 1)
+            self.pools.append(_ConnectionPool((host, int(port)), max_connections,
+                                              timeout, self.ioloop))
+
+    def _key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return self.prefix + md5(key).hexdigest()
+
+    def _pool(self, key):
+        return self.pools[(crc32(key) & 0xffffffff) % len(self.pools)]
+
+    def _get(self, pool, keys, callback):
+        def _command(stream, done):
+            stream.write("get %s\r\n" % " ".join(keys))
+            _read_values(stream, done)
+        pool.run(_command, callback)
+
+    def get(self, key, callback):
+        key = self._key(key)
+        pool = self._pool(key)
+
+        def _on_head(values):
+            if not values or key not in values:
+                callback(None)
+                return
+
+            (count, data) = values[key]
+            if count <= 1:
+                callback(data)
+                return
+
+            try:
+                (line, data) = data.split("\r\n", 1)
+                (token, length) = line.split(" ")
+                length = int(length)
+            except ValueError:
+                logger.error("Bad cache head for %s" % key)
+                callback(None)
+                return
+            parts = ["%s:%s:%d" % (key, token, i) for i in xrange(1, count)]
+            self._get(pool, parts, lambda rest: _on_parts(data, parts, length, rest))
+
+        def _on_parts(head, parts, length, rest):
+            if not rest or any(part not in rest for part in parts):
+                callback(None)
+                return
+            value = "".join([head] + [rest[part][1] for part in parts])
+            callback(value if len(value) == length else None)
+
+        self._get(pool, [key], _on_head)
+
+    def set(self, key, value, callback=None):
+        key = self._key(key)
+        chunks = [value[i:i + self.chunk_size]
+                  for i in xrange(0, len(value), self.chunk_size)] or [""]
+
+        if len(chunks) == 1:
+            items = [(key, 1, chunks[0])]
+        else:
+            # Parts go first, so the head never points at missing parts
+            # urandom, not random: forked workers share the random state
+            token = os.urandom(6).encode("hex")
+            items = [("%s:%s:%d" % (key, token, i), 0, chunks[i])
+                     for i in xrange(1, len(chunks))]
+            items.append((key, len(chunks), "%s %d\r\n%s" % (token, len(value), chunks[0])))
+
+        def _command(stream, done):
+            # One write, so the parts don't go out as separate small packets;
+            # the chunks are joined in as they are rather than formatted first
+            request = []
+            for (k, flags, data) in items:
+                request.extend(("set %s %d %d %d\r\n" % (k, flags, self.expire, len(data)),
+                                data, "\r\n"))
+            stream.write("".join(request))
+            replies = []
+
+            def _on_line(line):
+                replies.append(line.strip())
+                if len(replies) < len(items):
+                    stream.read_until('\r\n', _on_line)
+                else:
+                    done(all(r == 'STORED' for r in replies))
+
+            stream.read_until('\r\n', _on_line)
+
+        self._pool(key).run(_command, lambda result: callable(callback) and callback(bool(result)))
+
+    def delete(self, key, callback=None):
+        key = self._key(key)
+
+        def _command(stream, done):
+            stream.write("delete %s\r\n" % key)
+            stream.read_until('\r\n', lambda line: done(line.strip() == 'DELETED'))
+
+        self._pool(key).run(_command, lambda result: callable(callback) and callback(bool(result)))
+
+
+class SegmentStore(CacheStore):
+    """
+    CacheStore packing entries into large append-only segment files under
+    path, instead of one small file per variant.
+
+    Each record is a header (magic, key length, value length, timestamp,
+    tombstone flag) followed by the key and value.  An in-memory index maps
+    keys to (segment, offset, length, timestamp) and is rebuilt by scanning
+    the segments on startup.  Values are read through mmap.
+
+    Overwritten and deleted entries stay in their segment until its live
+    entries are copied forward and it's removed.  With auto_compact, the set
+    or delete that leaves a sealed segment at least compact_ratio dead
+    starts compacting it on the IOLoop, compact_step bytes per callback so
+    requests are served in between; compact() does it all at once.  Once
+    the store exceeds max_size the oldest segment is dropped as a whole.
+
+    Only one process may write to a store.  Callbacks are called before the
+    methods return: each set or delete is a single os.write() into the
+    page cache and reads are copied out of an mmap, on the IOLoop.
+    """
+
+    MAGIC = "ECTS"
+    HEADER = struct.Struct(">4sIIdB")
+
+    def __init__(self, path, segment_size=256 * 1024 * 1024, max_size=None,
+                 compact_ratio=0.5, auto_compact=True, compact_step=4 * 1024 * 1024,
+                 ioloop=None):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.compact_ratio = compact_ratio
+        self.auto_compact = auto_compact
+        self.compact_step = compact_step
+        self.ioloop = ioloop
+        self.index = {}
+        self.sizes = {}
+        self.live = {}
+        # Keys indexed in each segment
+        self.keys = {}
+        self._maps = {}
+        self._fd = None
+        self._active = None
+        self._compacting = False
+        # The compaction in progress, see _compaction()
+        self._compactor = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        segments = sorted(int(name[:-4]) for name in os.listdir(path)
+                          if name.endswith(".seg") and name[:-4].isdigit())
+        for segment in segments:
+            self._scan(segment)
+        self._open(segments[-1] if segments else 0)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "%08d.seg" % segment)
+
+    def _records(self, fh):
+        """
+        Yields (end offset, key, value length, timestamp, tombstone) for each
+        complete record in the segment file fh, stopping at the first partial
+        or corrupt one.
+        """
+        size = os.fstat(fh.fileno()).st_size
+        offset = 0
+        while True:
+            header = fh.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            (magic, key_len, value_len, timestamp, tombstone) = self.HEADER.unpack(header)
+            key = fh.read(key_len)
+            offset += self.HEADER.size + key_len + value_len
+            if magic != self.MAGIC or len(key) < key_len or offset > size:
+                return
+            fh.seek(value_len, os.SEEK_CUR)
+            yield (offset, key, value_len, timestamp, tombstone)
+
+    def _scan(self, segment):
+        """
+        Adds the records of segment to the index, truncating a partially
+        written record at its end.
+        """
+        self.sizes[segment] = 0
+        self.live[segment] = 0
+        self.keys[segment] = set()
+        fh = open(self._segment_path(segment), "r+b")
+        try:
+            end = 0
+            for (end, key, value_len, timestamp, tombstone) in self._records(fh):
+                self._unindex(key)
+                if not tombstone:
+                    self._index(key, (segment, end - value_len, value_len, timestamp))
+
+            if end < os.fstat(fh.fileno()).st_size:
+                logger.warning("Truncating %s at %d" % (self._segment_path(segment), end))
+                fh.truncate(end)
+            self.sizes[segment] = end
+        finally:
+            fh.close()
+
+    def _open(self, segment):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._active = segment
+        self._fd = os.open(self._segment_path(segment),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.sizes.setdefault(segment, 0)
+        self.live.setdefault(segment, 0)
+        self.keys.setdefault(segment, set())
+
+    def _index(self, key, entry):
+        self.index[key] = entry
+        self.live[entry[0]] += entry[2]
+        self.keys[entry[0]].add(key)
+
+    def _unindex(self, key):
+        entry = self.index.pop(key, None)
+        if entry:
+            self.live[entry[0]] -= entry[2]
+            self.keys[entry[0]].discard(key)
+
+    def _append(self, key, value, tombstone=False, timestamp=None):
+        if self.sizes[self._active] >= self.segment_size:
+            self._open(self._active + 1)
+
+        timestamp = timestamp or time()
+        # One write, so a failed write can't leave a header without its value
+        # in the middle of the segment
+        record = self.HEADER.pack(self.MAGIC, len(key), len(value), timestamp,
+                                  1 if tombstone else 0) + key + value
+        os.write(self._fd, record)
+
+        segment = self._active
+        self.sizes[segment] += len(record)
+        self._unindex(key)
+        if not tombstone:
+            self._index(key, (segment, self.sizes[segment] - len(value), len(value), timestamp))
+
+        if not self._compacting:
+            self._enforce_max_size()
+            if self.auto_compact and self._compactor is None and \
+                    self._compactable() is not None:
+                self._compactor = self._compaction()
+                (self.ioloop or IOLoop.current()).add_callback(self._compact_step)
+
+    def _enforce_max_size(self):
+        if self.max_size:
+            while sum(self.sizes.itervalues()) > self.max_size and len(self.sizes) > 1:
+                self._drop(min(self.sizes))
+
+    def _drop(self, segment):
+        """
+        Removes segment and every index entry pointing into it.
+        """
+        for key in self.keys.pop(segment):
+            del self.index[key]
+        m = self._maps.pop(segment, None)
+        if m:
+            m.close()
+        del self.sizes[segment]
+        del self.live[segment]
+        os.remove(self._segment_path(segment))
+
+    def _read(self, entry):
+        (segment, offset, length, timestamp) = entry
+        m = self._maps.get(segment)
+        if m is None or len(m) < offset + length:
+            if m:
+                m.close()
+            fh = open(self._segment_path(segment), "rb")
+            try:
+                m = self._maps[segment] = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fh.close()
+        return m[offset:offset + length]
+
+    def _key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
+    def get(self, key, callback):
+        entry = self.index.get(self._key(key))
+        callback(self._read(entry) if entry else None)
+
+    def stat(self, key, callback):
+        entry = self.index.get(self._key(key))
+        callback(entry[2:] if entry else None)
+
+    def set(self, key, value, callback=None):
+        self._append(self._key(key), value)
+        if callable(callback):
+            callback(True)
+
+    def delete(self, key, callback=None):
+        key = self._key(key)
+        existed = key in self.index
+        if existed:
+            self._append(key, "", tombstone=True)
+        if callable(callback):
+            callback(existed)
+
+    def compact(self):
+        """
+        Copies the live entries of sealed segments that are at least
+        compact_ratio dead into the active segment and removes them, all at
+        once (finishing any compaction in progress).  Returns the number of
+        bytes reclaimed.  max_size is enforced once compaction is done, so
+        no segment is dropped while it's copied.
+        """
+        if self._compactor is None:
+            self._compactor = self._compaction()
+        reclaimed = 0
+        try:
+            for (_, freed) in self._compactor:
+                reclaimed += freed
+        finally:
+            self._compactor = None
+        return reclaimed
+
+    def _compact_step(self):
+        """
+        Runs the compaction in progress for about compact_step bytes, then
+        schedules the rest on the IOLoop.
+        """
+        if self._compactor is None:
+            # Finished by compact()
+            return
+        work = 0
+        try:
+            while work < self.compact_step:
+                work += next(self._compactor)[0]
+        except StopIteration:
+            self._compactor = None
+            return
+        except Exception:
+            logger.exception("Compacting %s failed" % self.path)
+            self._compactor = None
+            return
+        (self.ioloop or IOLoop.current()).add_callback(self._compact_step)
+
+    def _compactable(self):
+        """
+        Returns the oldest sealed segment that is at least compact_ratio
+        dead, or None.
+        """
+        for segment in sorted(self.sizes):
+            size = self.sizes[segment]
+            if segment != self._active and size and \
+                    self.live[segment] <= size * (1 - self.compact_ratio):
+                return segment
+        return None
+
+    def _compaction(self):
+        """
+        Generator compacting segments one record at a time, yielding (bytes
+        of work, bytes reclaimed) after each.  Entries set or deleted
+        between steps are left alone.
+        """
+        self._compacting = True
+        try:
+            while True:
+                segment = self._compactable()
+                if segment is None:
+                    return
+                size = self.sizes[segment]
+                copied = 0
+
+                for key in list(self.keys[segment]):
+                    entry = self.index.get(key)
+                    if not entry or entry[0] != segment:
+                        continue
+                    self._append(key, self._read(entry), timestamp=entry[3])
+                    copied += entry[2]
+                    yield (self.HEADER.size + len(key) + entry[2], 0)
+
+                # Deletions must outlive older segments that still hold the value
+                if min(self.sizes) < segment:
+                    fh = open(self._segment_path(segment), "rb")
+                    try:
+                        for (_, key, _, _, tombstone) in self._records(fh):
+                            if tombstone and key not in self.index:
+                                self._append(key, "", tombstone=True)
+                            yield (self.HEADER.size + len(key), 0)
+                    finally:
+                        fh.close()
+
+                self._drop(segment)
+                yield (0, size - copied)
+        finally:
+            self._compacting = False
+            self._enforce_max_size()
+
+
+class PinnedStore(CacheStore):
+    """
+    CacheStore keeping the values of the hottest keys of another store in
+    memory.  The hot keys are the top most frequent items of the heavy
+    hitter table called table (see ectyper.stats.offer), which
+    CachingImageHandler fills with its cache keys, re-read every refresh
+    seconds.  At most
+    max_bytes of values are pinned; values of keys that are no longer hot
+    are unpinned on refresh.  Everything else goes to store:
+
+        CACHE_STORE = PinnedStore(MemcacheStore(["cache1:11211"]), top=500)
+    """
+
+    def __init__(self, store, top=100, max_bytes=64 * 1024 * 1024,
+                 table="cache_keys", refresh=10):
+        self.store = store
+        self.top = top
+        self.max_bytes = max_bytes
+        self.table = table
+        self.refresh = refresh
+        self.hot = frozenset()
+        self.refreshed = 0
+        # key -> (value, timestamp)
+        self.pinned = {}
+        self.pinned_bytes = 0
+
+    def _refresh(self):
+        if time() - self.refreshed < self.refresh:
+            return
+        self.refreshed = time()
+        self.hot = frozenset(key for (key, _, _) in stats.top(self.table, self.top))
+        for key in [key for key in self.pinned if key not in self.hot]:
+            self._unpin(key)
+        stats.set_gauge("pinned_bytes", self.pinned_bytes)
+        stats.set_gauge("pinned_entries", len(self.pinned))
+
+    def _pin(self, key, value, timestamp=None):
+        self._unpin(key)
+        if key in self.hot and self.pinned_bytes + len(value) <= self.max_bytes:
+            self.pinned[key] = (value, timestamp or time())
+            self.pinned_bytes += len(value)
+
+    def _unpin(self, key):
+        entry = self.pinned.pop(key, None)
+        if entry:
+            self.pinned_bytes -= len(entry[0])
+
+    def get(self, key, callback):
+        self._refresh()
+        entry = self.pinned.get(key)
+        if entry:
+            stats.incr("pinned_hits")
+            return callback(entry[0])
+
+        def _on_get(value):
+            if value is not None and key in self.hot:
+                # Keep the time the value was stored, for cache_age()
+                self.store.stat(key, lambda stat: self._pin(key, value, stat and stat[1]))
+            callback(value)
+        self.store.get(key, _on_get)
+
+    def stat(self, key, callback):
+        entry = self.pinned.get(key)
+        if entry:
+            return callback((len(entry[0]), entry[1]))
+        self.store.stat(key, callback)
+
+    def set(self, key, value, callback=None):
+        self._pin(key, value)
+        self.store.set(key, value, callback)
+
+    def delete(self, key, callback=None):
+        self._unpin(key)
+        self.store.delete(key, callback)
+
+
+class FileCacheWriter(object):
+    """
+    Writes cache files from background threads, so the IOLoop never waits on
+    the cache disk.  Each entry is written to a temporary file next to its
+    path and renamed into place.
+
+    At most max_bytes of entries wait to be written; entries that would go
+    over are dropped.  The cache_write_queue_depth and
+    cache_write_queued_bytes gauges and the cache_write_dropped_bytes counter
+    report on the queue.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, threads=1):
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.queue = Queue()
+        self.queued_bytes = 0
+        self._lock = Lock()
+        self._workers = []
+
+    def write(self, path, chunks, replace=False, mode=0755, callback=None):
+        """
+        Queues the entry made of chunks to be written to path, creating
+        directories with mode as needed.  An existing file is only replaced
+        if replace is set.  Returns False if the entry was dropped.
+
+        callback (if given) is called once the entry has been written or
+        dropped, from the writer's thread.
+        """
+        size = sum(len(chunk) for chunk in chunks)
+        with self._lock:
+            dropped = self.queued_bytes + size > self.max_bytes
+            if not dropped:
+                self.queued_bytes += size
+            self._start_workers()
+
+        if dropped:
+            logger.warning("Cache write queue full, dropping %s" % path)
+            stats.incr("cache_write_dropped_bytes", size)
+            if callable(callback):
+                # Still from the writer's thread, callbacks may block
+                self.queue.put((callback, path, 0, None))
+                self._update_gauges()
+            return False
+
+        self.queue.put((lambda: self._write(path, chunks, replace, mode), path, size, callback))
+        self._update_gauges()
+        return True
+
+    def call(self, function, name=None):
+        """
+        Queues function to be called from the writer's thread, for other
+        file operations that shouldn't run on the IOLoop.  name (e.g. a path)
+        is logged if it fails.
+        """
+        with self._lock:
+            self._start_workers()
+        self.queue.put((function, name or repr(function), 0, None))
+        self._update_gauges()
+
+    def _start_workers(self):
+        # Called with _lock held
+        if not self._workers:
+            for _ in xrange(self.threads):
+                worker = Thread(target=self._run, name="ectyper-cache-writer")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def join(self):
+        """
+        Blocks until every queued entry has been written.
+        """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            (function, name, size, callback) = self.queue.get()
+            try:
+                function()
+            except Exception:
+                logger.exception("Writing cache file %s failed" % name)
+            finally:
+                with self._lock:
+                    self.queued_bytes -= size
+                self._update_gauges()
+                if callable(callback):
+                    callback()
+                self.queue.task_done()
+
+    def _write(self, path, chunks, replace, mode):
+        if not replace and os.path.exists(path):
+            return
+
+        dname = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dname):
+                os.makedirs(dname, mode=mode)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
+
+        temp = "%s.cache.%d.%d" % (path, time(), randint(0, 10000))
+        try:
+            fh = open(temp, "wb")
+            try:
+                for chunk in chunks:
+                    fh.write(chunk)
+            finally:
+                fh.close()
+            os.rename(temp, path)
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def _update_gauges(self):
+        stats.set_gauge("cache_write_queue_depth", self.queue.qsize())
+        stats.set_gauge("cache_write_queued_bytes", self.queued_bytes)
@@ -0,0 +1,38 @@
+from bisect import bisect
+from hashlib import md5
+
+__all__ = ["HashRing"]
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return long(md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to nodes.  Each node is placed on the
+    ring replicas times, so keys spread evenly and adding or removing a node
+    only moves the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self._points = []
+        self._owners = {}
+        for node in self.nodes:
+            for i in xrange(replicas):
+                point = _hash("%s-%d" % (node, i))
+                self._points.append(point)
+                self._owners[point] = node
+        self._points.sort()
+
+    def get_node(self, key):
+        """
+        Returns the node owning key, or None if the ring is empty.
+        """
+        if not self._points:
+            return None
+        i = bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[i]]
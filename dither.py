@@ -0,0 +1,162 @@
+"""
+RGB555 dithering of decoded pixels with NumPy, in place of convert's
+-remap against gs5bit.png (see ImageMagick.rgb555_dither).  Colors are
+reduced to the 32 levels per channel of gs5bit.png (0, 8, ..., 128, then
+135, 143, ..., 247) and alpha is kept as it is.
+
+NumPy is optional: available() is False without it and ImageMagick falls
+back to -remap.
+"""
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ["available", "METHODS", "rgb555", "ordered", "diffuse",
+           "read_pam", "write_png"]
+
+# The gray levels of gs5bit.png (16-bit samples 2048 * n, less one past 32768,
+# scaled to 8 bits): steps of 8 up to 128, then 7 to 135 and 8 again
+LEVELS = range(0, 129, 8) + range(135, 248, 8)
+# Distance between the levels of a channel, near enough for the dither
+STEP = 8
+
+METHODS = ("ordered", "diffuse")
+
+
+def available():
+    """
+    Returns True if NumPy can be imported.
+    """
+    return numpy is not None
+
+
+def _bayer(n):
+    matrix = numpy.zeros((1, 1), dtype=numpy.float32)
+    while matrix.shape[0] < n:
+        matrix = numpy.vstack([numpy.hstack([4 * matrix, 4 * matrix + 2]),
+                               numpy.hstack([4 * matrix + 3, 4 * matrix + 1])])
+    return matrix
+
+_BAYER = _bayer(8) if numpy is not None else None
+
+
+_LEVELS = numpy.array(LEVELS, dtype=numpy.float32) if numpy is not None else None
+# Values above a midpoint are nearer the level above it
+_MIDPOINTS = (_LEVELS[:-1] + _LEVELS[1:]) / 2 if numpy is not None else None
+
+
+def _quantize(values):
+    """
+    Returns values with each one replaced by the nearest of LEVELS.
+    """
+    return _LEVELS[numpy.searchsorted(_MIDPOINTS, values)]
+
+
+def ordered(pixels):
+    """
+    Returns the RGBA pixels (an H x W x 4 uint8 array) with RGB reduced to 5
+    bits through an 8x8 Bayer matrix.
+    """
+    (height, width) = pixels.shape[:2]
+    # Thresholds centered on zero, spanning one level
+    threshold = (_BAYER + 0.5) / _BAYER.size - 0.5
+    tiles = numpy.tile(threshold, ((height + 7) / 8, (width + 7) / 8))[:height, :width]
+    out = pixels.copy()
+    rgb = pixels[:, :, :3].astype(numpy.float32) + (tiles * STEP)[:, :, numpy.newaxis]
+    out[:, :, :3] = _quantize(rgb)
+    return out
+
+
+def diffuse(pixels):
+    """
+    Returns the RGBA pixels (an H x W x 4 uint8 array) with RGB reduced to 5
+    bits by Floyd-Steinberg error diffusion.
+
+    Pixel (y, x) only depends on pixels with a smaller x + 2y, so the image
+    is processed one such anti-diagonal at a time, each as a vector.
+    """
+    (height, width) = pixels.shape[:2]
+    rgb = pixels[:, :, :3].astype(numpy.float32)
+    # Padded by a column on each side and a row below
+    error = numpy.zeros((height + 1, width + 2, 3), dtype=numpy.float32)
+    out = pixels.copy()
+
+    for t in xrange(width + 2 * (height - 1)):
+        ys = numpy.arange(max(0, (t - width + 2) / 2), min(height - 1, t / 2) + 1)
+        xs = t - 2 * ys
+        value = rgb[ys, xs] + error[ys, xs + 1]
+        quantized = _quantize(value)
+        out[ys, xs, :3] = quantized
+        residual = value - quantized
+        error[ys, xs + 2] += residual * (7 / 16.0)
+        error[ys + 1, xs] += residual * (3 / 16.0)
+        error[ys + 1, xs + 1] += residual * (5 / 16.0)
+        error[ys + 1, xs + 2] += residual * (1 / 16.0)
+    return out
+
+
+def rgb555(pixels, method="ordered"):
+    """
+    Dithers the RGBA pixels with method, one of METHODS.
+    """
+    if method == "diffuse":
+        return diffuse(pixels)
+    return ordered(pixels)
+
+
+def read_pam(data):
+    """
+    Returns the pixels of the PAM image data (as written by convert's pam:
+    coder, 8 bits per sample) as an H x W x 4 RGBA uint8 array.  RGBA
+    images are returned as a read-only view of data, without copying.
+    """
+    end = data.index("ENDHDR\n") + len("ENDHDR\n")
+    header = dict(line.split(None, 1) for line in data[:end].splitlines()[1:-1]
+                  if line and not line.startswith("#"))
+    (width, height, depth) = [int(header[key]) for key in ("WIDTH", "HEIGHT", "DEPTH")]
+    if int(header.get("MAXVAL", 255)) != 255:
+        raise ValueError("only 8-bit PAM images are supported")
+
+    samples = numpy.frombuffer(data, dtype=numpy.uint8, count=width * height * depth, offset=end)
+    samples = samples.reshape((height, width, depth))
+    if depth == 4:
+        return samples
+
+    pixels = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    pixels[:, :, 3] = 255
+    if depth == 3:
+        pixels[:, :, :3] = samples
+    else:
+        # GRAYSCALE or GRAYSCALE_ALPHA
+        pixels[:, :, :3] = samples[:, :, :1]
+        if depth == 2:
+            pixels[:, :, 3] = samples[:, :, 1]
+    return pixels
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + \
+        struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+def write_png(pixels, level=9):
+    """
+    Returns the RGBA pixels as an 8-bit RGBA PNG, every row with the Up
+    filter.
+    """
+    (height, width) = pixels.shape[:2]
+    rows = pixels.reshape((height, width * 4))
+    filtered = numpy.empty((height, width * 4 + 1), dtype=numpy.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 1:] = rows[0]
+    # uint8 arithmetic wraps around, as the filter wants
+    filtered[1:, 1:] = rows[1:] - rows[:-1]
+
+    return "\x89PNG\r\n\x1a\n" + \
+        _chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) + \
+        _chunk("IDAT", zlib.compress(buffer(filtered), level)) + \
+        _chunk("IEND", "")
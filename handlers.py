@@ -1,17 +1,127 @@
 import logging
 import os
+import re
 from errno import EEXIST
-from hashlib import md5
+from hashlib import md5, sha1
+from hmac import compare_digest
 from random import randint
+import shutil
+import socket
+from thread import get_ident
+from threading import Thread
 from time import time
-
-from ectyper.magick import ImageMagick, is_remote
+from urllib import urlencode
+
+from ectyper import monitor, stats
+from ectyper.cache import FileCacheWriter
+from ectyper.cluster import HashRing
+from ectyper.magick import ImageMagick, ConversionCancelled, ConversionError, is_remote
+from ectyper.server import InflightLocks
+from tornado import gen, stack_context
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, asynchronous, HTTPError
 
-__all__ = ["ImageHandler", "CachingImageHandler", "FileCachingImageHandler"]
+__all__ = ["ImageHandler", "CachingImageHandler", "FileCachingImageHandler",
+           "StoreCachingImageHandler", "SpriteSheetHandler", "StatsHandler",
+           "ProfileHandler"]
 
 logger = logging.getLogger("ectyper")
 
+# Hash rings keyed on the tuple of peers they were built from
+_rings = {}
+
+# Marks requests proxied by a peer, which are always served locally
+PEER_HEADER = "X-Ectyper-Peer"
+# Request headers route_to_owner forwards to the owner, and response headers
+# it relays back, so ranges and conditional requests work through a peer
+_PEER_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match")
+_PEER_RESPONSE_HEADERS = ("Content-Type", "Content-Range", "Etag", "Accept-Ranges",
+                          "Content-Length")
+
+# Marks background renders of sibling variants (see CachingImageHandler's
+# PREFETCH_SIBLINGS)
+PREFETCH_HEADER = "X-Ectyper-Prefetch"
+# PREFETCH_HEADER's value on this server's own prefetches, unless
+# PREFETCH_SECRET is set.  Made at import, so serve()'s workers share it.
+_prefetch_secret = os.urandom(16).encode("hex")
+
+# Sources that recently failed to fetch, and ("convert", routing key) of chains
+# that recently failed to convert, mapped to the time their negative cache
+# entry expires
+_failed_sources = {}
+FAILED_SOURCES_SIZE = 10000
+
+# Cache keys being re-rendered in the background, mapped to the start time
+_revalidating = {}
+
+# Sources last converted for each cache key, to re-render stale entries from
+_entry_sources = {}
+ENTRY_SOURCES_SIZE = 10000
+
+# Cache keys being converted by this process, mapped to the output so far and
+# the callbacks of the requests waiting for it
+_inflight = {}
+
+# InflightLocks keyed on their directory
+_inflight_locks = {}
+
+# Variants (sorted query strings) requested recently, keyed on path, as
+# (time, route, variant) tuples
+_recent_variants = {}
+
+# Variants requested together, keyed on (route, variant), as [number of
+# requests, TopK of the variants requested within PREFETCH_WINDOW of them]
+_siblings = {}
+SIBLINGS_SIZE = 10000
+
+# Digests of local sources, keyed on path, with the size and mtime they were
+# computed for
+_source_hashes = {}
+SOURCE_HASHES_SIZE = 10000
+
+# A single byte range, "bytes=first-last", "bytes=first-" or "bytes=-suffix"
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def known_source_hash(path):
+    """
+    Returns the hex SHA-1 of the local file at path if hash_source() has
+    computed it since the file last changed, otherwise None.  Only stats
+    the file, so it can be called from the IOLoop.
+    """
+    st = os.stat(path)
+    known = _source_hashes.get(path)
+    if known and known[:2] == (st.st_size, st.st_mtime):
+        return known[2]
+    return None
+
+
+def hash_source(path):
+    """
+    Returns the hex SHA-1 of the local file at path.  Digests are remembered
+    until the file's size or mtime changes.  Reads the whole file, so call
+    it off the IOLoop.
+    """
+    known = known_source_hash(path)
+    if known:
+        return known
+
+    st = os.stat(path)
+    digest = sha1()
+    fh = open(path, 'rb')
+    try:
+        for block in iter(lambda: fh.read(1024 * 1024), ""):
+            digest.update(block)
+    finally:
+        fh.close()
+
+    if len(_source_hashes) >= SOURCE_HASHES_SIZE:
+        _source_hashes.clear()
+    _source_hashes[path] = (st.st_size, st.st_mtime, digest.hexdigest())
+    return digest.hexdigest()
+
 
 class ImageHandler(RequestHandler):
     """
@@ -21,16 +131,86 @@ class ImageHandler(RequestHandler):
 
     IMAGE_MAGICK_CLASS = ImageMagick
 
+    # Identify local sources before converting them so operations that
+    # wouldn't change the image are dropped, and sources that need no
+    # transformation at all are served as-is.
+    PROBE_SOURCES = False
+
+    # With PROBE_SOURCES, resizes that shrink the source by at least this
+    # factor use -thumbnail (optionally with THUMBNAIL_FILTER), which is
+    # faster and drops profiles early.
+    THUMBNAIL_FACTOR = None
+    THUMBNAIL_FILTER = None
+
+    # "host:port" of every node serving this route, and of this node.  When
+    # set, each derivative has one owner on a consistent hash ring over its
+    # cache key, and other nodes proxy requests for it to the owner.  Use
+    # the curl AsyncHTTPClient to keep peer connections alive.
+    PEERS = None
+    SELF_PEER = None
+    PEER_TIMEOUT = 10.0
+
+    # Addresses trusted, like the IP addresses in PEERS, to send PEER_HEADER
+    # and PREFETCH_HEADER.  Both are ignored on requests from anywhere else,
+    # except for this server's own prefetches, which carry PREFETCH_SECRET.
+    TRUSTED_IPS = ()
+
+    # The PREFETCH_HEADER value marking this server's own prefetches, None
+    # for a random one.  Set a shared one if PREFETCH_URL leads elsewhere.
+    PREFETCH_SECRET = None
+
+    # Seconds to keep answering requests for a source whose fetch failed,
+    # or for a source and filter chain whose conversion failed, with a 500
+    # without trying again.
+    NEGATIVE_CACHE_TTL = None
+
+    # A Scheduler (see ectyper.scheduler), shared between handlers, that
+    # admits conversions by the priority class get_priority_class() picks.
+    # By default that is the class of the first (max cost, class) pair in
+    # PRIORITY_CLASSES covering the chain's estimated cost, where a max cost
+    # of None covers any cost.
+    SCHEDULER = None
+    PRIORITY_CLASSES = None
+
+    # Local sources of more than this many pixels, as probed from their
+    # header, are converted in large-image mode (see ImageMagick.limit_memory)
+    # with convert's pixel cache limited to LARGE_IMAGE_LIMITS (memory, map).
+    LARGE_IMAGE_PIXELS = None
+    LARGE_IMAGE_LIMITS = ("256MiB", "512MiB")
+
+    # Directory of cached text layers: transparent images of styled text,
+    # composited like overlays instead of drawing the text on every request.
+    TEXT_LAYER_DIR = None
+
+    # Dithers format=png16 with NumPy (ectyper.dither), "ordered" or
+    # "diffuse", rather than convert's -remap.  Ignored without NumPy.
+    DITHER_METHOD = None
+
+    # Sizes the size parameter is snapped to, so near-identical requests
+    # share one derivative: a list of allowed (w, h) sizes, or the step of a
+    # grid both dimensions are rounded to.  In "snap" SIZE_POLICY_MODE the
+    # nearest allowed size is served, in "redirect" mode the request is
+    # redirected to the URL asking for it.
+    SIZE_POLICY = None
+    SIZE_POLICY_MODE = "snap"
+
     def __init__(self, *args, **kwargs):
         super(ImageHandler, self).__init__(*args, **kwargs)
         self.magick = None
         self.local_image_dir = None
         self.local_font_dir = None
+        self.source_info = None
+        self.client_closed = False
+        self.serve_locally = False
+        self.source = None
+        self.admission = None
+        self.snapped_size = None
 
     def handler(self, *args):
         """
         Primary entry point for your code.  Override this method
-        and process the request as necessary.
+        and process the request as necessary.  It may be a coroutine, in
+        which case the request is finished once it returns.
         """
         raise NotImplementedError()
 
@@ -38,11 +218,196 @@ class ImageHandler(RequestHandler):
     def get(self, *args):
         ""
         self.calculate_options()
-        self.handler(*args)
+        if self.redirect_to_policy():
+            return
+        if self.route_to_owner(lambda: self.finish_when_done(self.handler(*args))):
+            return
+        return self.handler(*args)
+
+    def finish_when_done(self, result):
+        """
+        Finishes the request once result, the return value of a coroutine
+        handler called outside of get(), resolves.  Does nothing for None.
+        """
+        if result is not None:
+            IOLoop.current().add_future(gen.convert_yielded(result), self._on_handler_done)
+
+    def _on_handler_done(self, future):
+        future.result()
+        if not self._finished:
+            self.finish()
+
+    def get_routing_key(self):
+        """
+        Returns the key requests are spread over peers by: the request path
+        with the filter chain and format.
+        """
+        return "%s/%s.%s" % (self.request.path, "+".join(self.magick.filters) or "base",
+                             self.magick.format)
+
+    def get_owner(self):
+        """
+        Returns the peer owning this request, or None if peer routing is off.
+        """
+        if not self.PEERS or not self.SELF_PEER:
+            return None
+
+        peers = tuple(self.PEERS)
+        ring = _rings.get(peers)
+        if ring is None:
+            ring = _rings[peers] = HashRing(peers)
+        return ring.get_node(self.get_routing_key())
+
+    def route_to_owner(self, fallback):
+        """
+        Proxies the request to the peer owning it, if that isn't this node.
+        Returns True if the request was proxied.  fallback is called to serve
+        the request locally if the owner can't be reached.  The method and
+        range and conditional headers are passed on, and the owner's status
+        and range, validator and length headers come back.
+        """
+        if self.serve_locally or self.is_peer_request():
+            return False
+        owner = self.get_owner()
+        if not owner or owner == self.SELF_PEER:
+            return False
+
+        def _on_response(response):
+            if response.code in (200, 206, 304, 416):
+                stats.incr("peer_proxied")
+                self.set_status(response.code)
+                self.set_header("Content-Type", self.magick.get_mime_type())
+                for name in _PEER_RESPONSE_HEADERS:
+                    if name in response.headers:
+                        self.set_header(name, response.headers[name])
+                if response.body and self.request.method != "HEAD":
+                    self.write(response.body)
+                self.finish()
+            elif 400 <= response.code < 500:
+                raise HTTPError(response.code)
+            else:
+                logger.warning("Peer %s failed for %s (%d), serving locally" % (
+                    owner, self.request.uri, response.code))
+                stats.incr("peer_failed")
+                self.serve_locally = True
+                fallback()
+
+        headers = {PEER_HEADER: self.SELF_PEER}
+        if self.is_prefetch():
+            headers[PREFETCH_HEADER] = "1"
+        for name in _PEER_REQUEST_HEADERS:
+            if name in self.request.headers:
+                headers[name] = self.request.headers[name]
+
+        logger.debug("proxying %s %s to %s" % (self.request.method, self.request.uri, owner))
+        AsyncHTTPClient().fetch(
+            HTTPRequest("http://%s%s" % (owner, self.request.uri),
+                        method=self.request.method,
+                        headers=headers,
+                        request_timeout=self.PEER_TIMEOUT),
+            callback=_on_response)
+        return True
+
+    def get_local_address(self):
+        """
+        Returns the (host, port) of the socket this request arrived on, or
+        None if it isn't a TCP socket.
+        """
+        try:
+            address = self.request.connection.stream.socket.getsockname()
+        except (AttributeError, socket.error):
+            return None
+        return address[:2] if isinstance(address, tuple) else None
+
+    def is_trusted(self):
+        """
+        Returns True if the request comes from a peer (an IP address in
+        PEERS) or TRUSTED_IPS.  Loopback and this server's own address
+        aren't trusted unless listed, as proxies forward from them.
+        """
+        remote_ip = self.request.remote_ip
+        if remote_ip in self.TRUSTED_IPS:
+            return True
+        return any(peer.rsplit(":", 1)[0].strip("[]") == remote_ip for peer in self.PEERS or ())
+
+    def is_peer_request(self):
+        """
+        Returns True if a trusted peer proxied this request to this node.
+        """
+        return bool(self.request.headers.get(PEER_HEADER)) and self.is_trusted()
+
+    def get_prefetch_secret(self):
+        return self.PREFETCH_SECRET or _prefetch_secret
+
+    def is_prefetch(self):
+        """
+        Returns True if this request is a background render of a sibling
+        variant: it carries PREFETCH_HEADER, set to the prefetch secret by
+        this server or to anything by a trusted peer.
+        """
+        value = self.request.headers.get(PREFETCH_HEADER)
+        if not value:
+            return False
+        return compare_digest(value, self.get_prefetch_secret()) or self.is_trusted()
+
+    def on_connection_close(self):
+        """
+        Cancels the running conversion when the client goes away.
+        """
+        self.client_closed = True
+        self.cancel_conversion()
+
+    def cancel_conversion(self):
+        """
+        Kills the running conversion (convert and curl), unless something
+        other than the client still needs its output.
+        """
+        if not self.magick or self.conversion_needed():
+            return
+        queued = self.admission and not self.admission.admitted
+        if queued:
+            self.end_admission()
+        if queued or self.magick.cancel():
+            stats.incr("conversions_cancelled")
+
+    def conversion_needed(self):
+        """
+        Returns True if the output of the conversion is still needed once the
+        client has gone away.
+        """
+        return False
 
     def parse_size(self, size):
         return self.parse_2d_param(size)
 
+    def snap_size(self, size):
+        """
+        Returns the size allowed by SIZE_POLICY nearest to size.
+        """
+        if not self.SIZE_POLICY or not size:
+            return size
+
+        (w, h) = size
+        if isinstance(self.SIZE_POLICY, (int, long)):
+            step = self.SIZE_POLICY
+            return (max(step, int(round(float(w) / step)) * step),
+                    max(step, int(round(float(h) / step)) * step))
+        return min(self.SIZE_POLICY, key=lambda (aw, ah): abs(aw - w) + abs(ah - h))
+
+    def redirect_to_policy(self):
+        """
+        In "redirect" SIZE_POLICY_MODE, redirects requests whose size was
+        snapped to the URL asking for the snapped size.  Returns True if the
+        request was redirected.
+        """
+        if self.SIZE_POLICY_MODE != "redirect" or not self.snapped_size:
+            return False
+
+        arguments = dict(self.request.arguments)
+        arguments["size"] = ["%dx%d" % self.snapped_size]
+        self.redirect("%s?%s" % (self.request.path, urlencode(sorted(arguments.items()), True)))
+        return True
+
     def parse_quality(self, quality):
         if not quality:
             return None
@@ -111,18 +476,28 @@ class ImageHandler(RequestHandler):
             return
 
         magick = self.IMAGE_MAGICK_CLASS()
+        magick.thumbnail_factor = self.THUMBNAIL_FACTOR
+        magick.thumbnail_filter = self.THUMBNAIL_FILTER
+        magick.text_layer_dir = self.TEXT_LAYER_DIR
 
         size = self.parse_size(self.get_argument("size", None))
+        size_param = self.get_argument("size", None)
+        snapped = self.snap_size(size)
+        if snapped != size:
+            logger.debug("snapping size %dx%d to %dx%d" % (size + snapped))
+            stats.incr("sizes_snapped")
+            self.snapped_size = size = snapped
+            size_param = "%dx%d" % size
         quality = self.parse_quality(self.get_argument("quality", None))
 
         extent = int(self.get_argument("extent", 0)) == 1
-        extent_size = self.parse_size(self.get_argument("extent_size", self.get_argument("size", None)))
+        extent_size = self.parse_size(self.get_argument("extent_size", size_param))
         extent_anchor = self.get_argument("extent_anchor", "center")
         extent_background = self.get_argument("extent_background", "#00000000")
         extent_compose = self.restrict_compose_method(self.get_argument("extent_compose", "over"))
 
         splice = int(self.get_argument("splice", 0)) == 1
-        splice_size = self.parse_size(self.get_argument("splice_size", self.get_argument("size", None)))
+        splice_size = self.parse_size(self.get_argument("splice_size", size_param))
         splice_anchor = self.get_argument("splice_anchor", "center")
         splice_background = self.get_argument("splice_background", "#00000000")
         splice_compose = self.restrict_compose_method(self.get_argument("splice_compose", "over"))
@@ -282,7 +657,7 @@ class ImageHandler(RequestHandler):
         if format_param[0:3] == "png":
             magick.format = magick.PNG
             if format_param == "png16":
-                magick.rgb555_dither()
+                magick.rgb555_dither(method=self.DITHER_METHOD)
         else:
             # Force this in earlier to fix weird color banding issues
             magick.options = ['-colorspace', 'sRGB'] + magick.options
@@ -331,25 +706,244 @@ class ImageHandler(RequestHandler):
         finishing the request.  Raises a 404 error if the file is local and
         doesn't exist, or if source is None.
         """
+        if not self.begin_conversion(source):
+            return
+
+        def _on_prepared(convert):
+            if convert:
+                self.start_conversion(source)
+
+        self.prepare_conversion(source, _on_prepared)
+
+    def start_conversion(self, source):
+        """
+        Runs the conversion of source, once admitted, through the on_conv_*
+        callbacks.
+        """
+        def _start():
+            self.magick.convert(source,
+                                chunk_ready=self.on_conv_chunk_ready,
+                                complete=self.after_conversion(self.on_conv_complete),
+                                error=self.after_conversion(self.on_conv_error),
+                                cancelled=self.on_conv_cancelled)
+
+        self.admit_conversion(_start, cancelled=self.on_conv_cancelled)
+
+    @gen.coroutine
+    def convert_image_async(self, source):
+        """
+        Coroutine version of convert_image, for handlers that are coroutines:
+
+            @gen.coroutine
+            def handler(self, *args):
+                source = yield self.lookup_source(args[0])
+                yield self.convert_image_async(source)
+
+        Output goes through the same on_conv_* callbacks as convert_image.
+        """
+        if not self.begin_conversion(source):
+            return
+        prepared = Future()
+        self.prepare_conversion(source, prepared.set_result)
+        if not (yield prepared):
+            return
+
+        admitted = Future()
+        self.admit_conversion(lambda: admitted.set_result(True),
+                              cancelled=lambda: admitted.set_result(False))
+        if not (yield admitted):
+            # Cancelled while queued
+            self.on_conv_cancelled()
+            return
+        try:
+            stream = self.magick.convert_stream(source)
+            while True:
+                try:
+                    chunk = yield stream.read_chunk()
+                except ConversionCancelled:
+                    self.on_conv_cancelled()
+                    return
+                except ConversionError:
+                    self.on_conv_error()
+                    return
+
+                if chunk is None:
+                    break
+                self.on_conv_chunk_ready(chunk)
+        finally:
+            self.end_admission()
+            self.record_usage()
+
+        self.on_conv_complete()
+
+    def get_priority_class(self):
+        """
+        Returns the priority class the SCHEDULER admits this request's
+        conversion in.  Override to pick classes by route or parameter.
+        """
+        cost = self.magick.estimate_cost(self.source_info)
+        for (max_cost, priority) in self.PRIORITY_CLASSES or ():
+            if max_cost is None or cost <= max_cost:
+                return priority
+        return "default"
+
+    def admit_conversion(self, callback, cancelled=None):
+        """
+        Calls callback once the SCHEDULER admits the conversion, or right
+        away without a SCHEDULER.  end_admission() must be called when the
+        conversion is over.  cancelled (if given) is called instead if the
+        conversion is cancelled while it waits.
+        """
+        if not self.SCHEDULER:
+            callback()
+            return
+        self.admission = self.SCHEDULER.admit(self.get_priority_class(), callback, cancelled)
+
+    def end_admission(self):
+        """
+        Gives the conversion's slot back to the SCHEDULER, or leaves its queue.
+        """
+        if self.admission:
+            self.SCHEDULER.release(self.admission)
+            self.admission = None
+
+    def after_conversion(self, callback):
+        """
+        Returns callback wrapped to call end_admission() and record_usage()
+        first.
+        """
+        def _wrapper(*args):
+            self.end_admission()
+            self.record_usage()
+            return callback(*args)
+        return _wrapper
+
+    def record_usage(self):
+        """
+        Reports the peak RSS (in KB) of the finished convert process to stats.
+        """
+        rusage = self.magick.rusage
+        if rusage:
+            stats.set_gauge("conversion_rss_kb", rusage.ru_maxrss)
+            stats.set_max("conversion_rss_kb_max", rusage.ru_maxrss)
+
+    def begin_conversion(self, source):
+        """
+        Validates the source before converting it.  Returns False if the
+        request was served without a conversion.
+        """
         assert self.magick
 
         logger.debug("converting %s" % source)
         if not source or (not is_remote(source) and not os.path.isfile(source)):
             raise HTTPError(404)
 
+        self.source = source
+        if self.NEGATIVE_CACHE_TTL:
+            now = time()
+            if _failed_sources.get(source, 0) > now or \
+                    _failed_sources.get(("convert", self.get_routing_key()), 0) > now:
+                logger.debug("%s failed recently" % self.request.uri)
+                stats.incr("negative_cache_hits")
+                raise HTTPError(500)
+
+        # The client left while the handler was looking up the source
+        return not self.conversion_abandoned()
+
+    def conversion_abandoned(self):
+        """
+        Returns True, and cancels the conversion, if the client has gone
+        away and nothing else needs its output.
+        """
+        if self.client_closed and not self.conversion_needed():
+            stats.incr("conversions_cancelled")
+            self.on_conv_cancelled()
+            return True
+        return False
+
+    def prepare_conversion(self, source, callback):
+        """
+        Probes the local source if needed, running identify without blocking
+        the IOLoop, and plans the conversion.  Then calls callback with True
+        if the source is still to be converted, or False if the request was
+        served without a conversion or abandoned meanwhile.
+        """
+        if not (self.PROBE_SOURCES or self.LARGE_IMAGE_PIXELS) or is_remote(source):
+            callback(self.plan_conversion(source))
+            return
+
+        def _on_probe(info):
+            self.source_info = info
+            callback(not self.conversion_abandoned() and self.plan_conversion(source))
+
+        self.magick.probe(source, callback=_on_probe)
+
+    def plan_conversion(self, source):
+        """
+        Plans the filter chain for source_info and sets the Content-Type.
+        Returns False if the source was served untouched instead.
+        """
+        if self.PROBE_SOURCES and self.source_info:
+            self.magick.plan(self.source_info)
+            if self.magick.is_identity(self.source_info):
+                logger.debug("serving %s untouched" % source)
+                self.set_content_type()
+                self.send_source(source)
+                return False
+
+        info = self.source_info
+        if self.LARGE_IMAGE_PIXELS and info and info.width * info.height > self.LARGE_IMAGE_PIXELS:
+            logger.info("converting %s (%dx%d) in large-image mode" % (source, info.width, info.height))
+            stats.incr("large_images")
+            self.magick.limit_memory(info, *self.LARGE_IMAGE_LIMITS)
+
         self.set_content_type()
-        self.magick.convert(source,
-                            chunk_ready=self.on_conv_chunk_ready,
-                            complete=self.on_conv_complete,
-                            error=self.on_conv_error)
+        return True
+
+    def send_source(self, source):
+        """
+        Passes the bytes of the local source through the conversion callbacks
+        unchanged.  Used when the filter chain is an identity for the source.
+        """
+        fh = open(source, 'rb')
+        try:
+            chunk = fh.read()
+        finally:
+            fh.close()
+
+        if chunk:
+            self.on_conv_chunk_ready(chunk)
+        self.on_conv_complete()
 
     def on_conv_error(self):
         """
         On conversion error, raise a 500 Server Error and log.
         """
         logger.error("Conversion failed for %s" % self.request.uri)
+        self.remember_failure()
         raise HTTPError(500)
 
+    def remember_failure(self):
+        """
+        Adds the failure to the negative cache, if enabled: the source if it
+        couldn't be fetched, otherwise the source with this filter chain, so
+        a request with bad options doesn't block the source's other
+        variants.
+        """
+        if self.NEGATIVE_CACHE_TTL and self.source:
+            if len(_failed_sources) >= FAILED_SOURCES_SIZE:
+                now = time()
+                for (key, expires) in _failed_sources.items():
+                    if expires <= now:
+                        del _failed_sources[key]
+                if len(_failed_sources) >= FAILED_SOURCES_SIZE:
+                    _failed_sources.clear()
+            if self.magick.failed_process == "curl":
+                key = self.source
+            else:
+                key = ("convert", self.get_routing_key())
+            _failed_sources[key] = time() + self.NEGATIVE_CACHE_TTL
+
     def on_conv_chunk_ready(self, chunk):
         """
         When a chunk of the converted image is ready, this callback is
@@ -365,37 +959,629 @@ class ImageHandler(RequestHandler):
         """
         self.finish()
 
+    def on_conv_cancelled(self):
+        """
+        Called instead of on_conv_complete or on_conv_error when the
+        conversion is cancelled, or skipped, because the client went away.
+        The request never finishes, so on_finish() doesn't run.
+        """
+        self.end_admission()
+
+
+class SpriteSheetHandler(ImageHandler):
+    """
+    Renders many images from local_image_dir with one set of options into a
+    single sprite sheet, in one convert process:
+
+        /sprites?sources=a.jpg,b.jpg,c.jpg&size=96x54&columns=10
+
+    Each source goes through the chain the query describes and is centered
+    on a size cell; cells are laid out left to right, columns per row.  With
+    map=1 the coordinates of each source on the sheet are returned as JSON
+    instead.
+    """
+
+    MAX_TILES = 100
+    DEFAULT_COLUMNS = 10
+
+    def handler(self, *args):
+        names = [n for n in self.get_argument("sources", "").split(",") if n]
+        size = self.snap_size(self.parse_size(self.get_argument("size", None)))
+        if not names or len(names) > self.MAX_TILES or not size:
+            raise HTTPError(400)
+
+        paths = []
+        for name in names:
+            path = self.get_sprite_source(name)
+            if not path or not os.path.isfile(path):
+                raise HTTPError(404)
+            paths.append(path)
+
+        (w, h) = size
+        try:
+            columns = int(self.get_argument("columns", self.DEFAULT_COLUMNS))
+        except ValueError:
+            raise HTTPError(400)
+        columns = max(1, min(columns, len(names)))
+
+        if self.get_argument("map", None) == "1":
+            self.write(self.sprite_map(names, w, h, columns))
+            self.finish()
+            return
+
+        background = self.get_argument("background", "white" if self.magick.format == self.magick.JPEG
+                                       else "#00000000")
+        self.magick.sprite_sheet(paths, w, h, columns, background)
+        self.set_content_type()
+        self.start_conversion(None)
+
+    def get_sprite_source(self, name):
+        """
+        Returns the local path of the source called name, or None if there's
+        no such source.  Relative paths are not allowed.
+        """
+        if not self.local_image_dir or os.path.basename(name) != name or name.startswith("."):
+            return None
+        return os.path.join(self.local_image_dir, name)
+
+    def sprite_map(self, names, w, h, columns):
+        """
+        Returns the layout of a sprite sheet of names, in w x h cells.
+        """
+        rows = (len(names) + columns - 1) / columns
+        return {
+            "width": columns * w,
+            "height": rows * h,
+            "tiles": [{"source": name, "x": (i % columns) * w, "y": (i / columns) * h,
+                       "width": w, "height": h}
+                      for (i, name) in enumerate(names)],
+        }
+
 
 class CachingImageHandler(ImageHandler):
     """
     ImageHandler that caches requests as necessary. You should override the
-    get_cache_name, on_cache_hit and on_cache_write methods.
+    is_cached, on_cache_hit and on_cache_write methods.
     """
 
+    # Seconds a cached entry stays fresh.  Hits on older entries (see
+    # cache_age) are served as they are, then re-rendered in the background
+    # from the source get_source() returns.
+    CACHE_FRESHNESS = None
+
+    # Seconds after which a background re-render is assumed lost
+    REVALIDATE_TIMEOUT = 60
+
+    # Misses arriving while a conversion of the same cache key runs in this
+    # process wait for it and are served its output.
+    COALESCE_CONVERSIONS = False
+
+    # Directory of lock files (see ectyper.server.InflightLocks) through
+    # which processes on this machine wait for each other's conversions of a
+    # cache key, looking it up every INFLIGHT_POLL seconds.  After
+    # INFLIGHT_TIMEOUT seconds the request is converted anyway.
+    INFLIGHT_DIR = None
+    INFLIGHT_POLL = 0.1
+    INFLIGHT_TIMEOUT = 30
+
+    # Size of the heavy hitter tables (see ectyper.stats.TopK) counting the
+    # most requested cache keys, source paths, option signatures and URIs.
+    # None turns them off.
+    HEAVY_HITTERS = 1000
+
+    # After a miss, renders up to PREFETCH_SIBLINGS other variants of the same
+    # path in the background: those requested within PREFETCH_WINDOW seconds
+    # of this variant at least PREFETCH_MIN_SHARE of the time, as learned per
+    # handler class.  Prefetches are HEAD requests to PREFETCH_URL (default
+    # this server's own address, over http), converted in the
+    # PREFETCH_PRIORITY class.
+    PREFETCH_SIBLINGS = 0
+    PREFETCH_WINDOW = 0.5
+    PREFETCH_MIN_SHARE = 0.3
+    PREFETCH_URL = None
+    PREFETCH_PRIORITY = "prefetch"
+    PREFETCH_TIMEOUT = 60
+
+    def __init__(self, *args, **kwargs):
+        super(CachingImageHandler, self).__init__(*args, **kwargs)
+        self.identifier = None
+        self.revalidating = False
+        self.inflight = None
+        self.inflight_lock = None
+
     @asynchronous
     def get(self, *args):
         self.calculate_options()
-        if self.is_cached():
+        if self.redirect_to_policy():
+            return
+        self.count_request()
+        self.learn_siblings()
+        return self.lookup_cache(lambda cached: self.on_cache_lookup(cached, *args))
+
+    # Hits are answered from cache_metadata(), misses convert like a GET and
+    # tornado drops the body.
+    head = get
+
+    def count_request(self):
+        """
+        Counts this request in the cache_keys, sources, options and requests
+        heavy hitter tables.
+        """
+        if not self.HEAVY_HITTERS or self.is_prefetch():
+            return
+        capacity = self.HEAVY_HITTERS
+        stats.offer("cache_keys", self.get_cache_key(), capacity=capacity)
+        stats.offer("sources", self.request.path, capacity=capacity)
+        stats.offer("options", "+".join(self.magick.filters) or "base", capacity=capacity)
+        stats.offer("requests", self.request.uri, capacity=capacity)
+
+    def lookup_cache(self, callback):
+        """
+        Calls callback with whether this request is already cached and returns
+        its result.  The default asks is_cached(); stores that need I/O to
+        answer override this and call back later.
+        """
+        return callback(self.is_cached())
+
+    def on_cache_lookup(self, cached, *args):
+        """
+        Serves the request from cache or hands it to the handler.
+        """
+        if cached:
+            stats.incr("cache_hits")
             self.set_content_type()
-            self.on_cache_hit()
+            metadata = self.cache_metadata()
+            if metadata:
+                self.set_header("Etag", metadata["etag"])
+                self.set_header("Accept-Ranges", "bytes")
+            if metadata and self.check_etag_header():
+                self.set_status(304)
+            elif metadata and self.request.method == "HEAD":
+                self.set_header("Content-Length", metadata["size"])
+            else:
+                self.on_cache_hit()
             self.finish()
+            if self.is_stale():
+                self.revalidate(*args)
         else:
+            if self.route_to_owner(lambda: self.finish_when_done(self.on_cache_lookup(False, *args))):
+                return
+            if self.wait_for_conversion(*args):
+                return
+            stats.incr("cache_misses")
+            self.prefetch_siblings()
+            self.on_cache_miss()
+            return self.handler(*args)
+
+    def get_variant(self):
+        """
+        Returns the options of this request as a canonical query string.
+        """
+        return urlencode(sorted((name, value) for (name, values) in self.request.arguments.iteritems()
+                                for value in values))
+
+    def learn_siblings(self):
+        """
+        Records this request's variant as requested together with the other
+        variants of its path requested within PREFETCH_WINDOW seconds.
+        """
+        if not self.PREFETCH_SIBLINGS or self.is_prefetch() or self.is_peer_request():
+            return
+
+        now = time()
+        route = self.__class__.__name__
+        variant = self.get_variant()
+        path = self.request.path
+        if len(_siblings) >= SIBLINGS_SIZE:
+            _siblings.clear()
+        if len(_recent_variants) >= SIBLINGS_SIZE:
+            for (key, recent) in _recent_variants.items():
+                if now - recent[-1][0] > self.PREFETCH_WINDOW:
+                    del _recent_variants[key]
+            if len(_recent_variants) >= SIBLINGS_SIZE:
+                _recent_variants.clear()
+
+        def _entry(variant):
+            entry = _siblings.get((route, variant))
+            if entry is None:
+                entry = _siblings[(route, variant)] = [0, stats.TopK(16)]
+            return entry
+
+        entry = _entry(variant)
+        entry[0] += 1
+        recent = [r for r in _recent_variants.get(path, ()) if now - r[0] <= self.PREFETCH_WINDOW]
+        for other in set(v for (_, r, v) in recent if r == route and v != variant):
+            entry[1].offer(other)
+            _entry(other)[1].offer(variant)
+        recent.append((now, route, variant))
+        _recent_variants[path] = recent
+
+    def get_siblings(self):
+        """
+        Returns the variants to prefetch after a miss on this request.
+        """
+        entry = _siblings.get((self.__class__.__name__, self.get_variant()))
+        if not entry:
+            return []
+        (requests, table) = entry
+        return [variant for (variant, count, error) in table.top(self.PREFETCH_SIBLINGS)
+                if count - error >= requests * self.PREFETCH_MIN_SHARE]
+
+    def prefetch_siblings(self):
+        """
+        Requests the sibling variants of this request in the background, so
+        they're cached by the time the client asks for them.
+        """
+        if not self.PREFETCH_SIBLINGS or self.revalidating or self.is_prefetch() or \
+                self.is_peer_request():
+            return
+
+        base = self.PREFETCH_URL
+        if not base:
+            # Never the client's Host header, which would let clients point
+            # prefetches anywhere
+            address = self.get_local_address()
+            if not address:
+                return
+            (host, port) = address
+            base = "http://%s:%d" % ("[%s]" % host if ":" in host else host, port)
+
+        def _on_response(response):
+            if response.error:
+                logger.debug("prefetching %s failed: %s" % (response.request.url, response.error))
+                stats.incr("prefetch_failed")
+
+        for variant in self.get_siblings():
+            logger.debug("prefetching %s?%s" % (self.request.path, variant))
+            stats.incr("prefetches")
+            AsyncHTTPClient().fetch(
+                HTTPRequest("%s%s?%s" % (base, self.request.path, variant), method="HEAD",
+                            headers={PREFETCH_HEADER: self.get_prefetch_secret()},
+                            request_timeout=self.PREFETCH_TIMEOUT),
+                callback=_on_response)
+
+    def get_priority_class(self):
+        if self.is_prefetch():
+            return self.PREFETCH_PRIORITY
+        return super(CachingImageHandler, self).get_priority_class()
+
+    def get_inflight_locks(self):
+        """
+        Returns the InflightLocks of INFLIGHT_DIR, or None if it isn't set.
+        """
+        if not self.INFLIGHT_DIR:
+            return None
+        locks = _inflight_locks.get(self.INFLIGHT_DIR)
+        if locks is None:
+            locks = _inflight_locks[self.INFLIGHT_DIR] = InflightLocks(self.INFLIGHT_DIR)
+        return locks
+
+    def wait_for_conversion(self, *args):
+        """
+        Returns True if the request will be served by a conversion of its
+        cache key already running in this or another process.  Otherwise
+        marks the key as being converted by this request.
+        """
+        key = self.get_cache_key()
+        if self.COALESCE_CONVERSIONS and key in _inflight:
+            logger.debug("waiting for the conversion of %s" % key)
+            stats.incr("conversions_coalesced")
+            _inflight[key]["waiters"].append(lambda output: self.on_shared_output(output, *args))
+            return True
+
+        locks = self.get_inflight_locks()
+        if locks:
+            if not locks.acquire(key):
+                logger.debug("waiting for another process to convert %s" % key)
+                stats.incr("conversions_awaited")
+                self.poll_conversion(time() + self.INFLIGHT_TIMEOUT, *args)
+                return True
+            self.inflight_lock = key
+
+        if self.COALESCE_CONVERSIONS:
+            self.inflight = _inflight[key] = {"chunks": [], "waiters": []}
+        return False
+
+    def poll_conversion(self, deadline, *args):
+        """
+        Looks the request up until another process has cached it.  Converts
+        it here if that process goes away without caching it, or at deadline.
+        """
+        if self.client_closed:
+            return
+
+        def _on_lookup(cached):
+            if cached:
+                return self.on_cache_lookup(True, *args)
+
+            key = self.get_cache_key()
+            locks = self.get_inflight_locks()
+            if time() < deadline and locks.held(key):
+                IOLoop.current().add_timeout(
+                    time() + self.INFLIGHT_POLL,
+                    lambda: self.finish_when_done(self.poll_conversion(deadline, *args)))
+                return
+
+            if locks.acquire(key):
+                self.inflight_lock = key
             self.on_cache_miss()
-            self.handler(*args)
+            return self.handler(*args)
+
+        return self.lookup_cache(_on_lookup)
+
+    def on_shared_output(self, output, *args):
+        """
+        Serves the output of the conversion this request waited for, or
+        converts the request itself if that conversion failed (output is
+        None).
+        """
+        if self.client_closed:
+            return
+        try:
+            if output is None:
+                self.on_cache_miss()
+                self.finish_when_done(self.handler(*args))
+                return
+            self.set_content_type()
+            self.write(output)
+            self.finish()
+        except HTTPError, e:
+            self.send_error(e.status_code)
+        except Exception:
+            logger.exception("Serving %s failed" % self.request.uri)
+            self.send_error(500)
+
+    def share_output(self, output):
+        """
+        Hands output (None if the conversion failed) to the requests waiting
+        for this request's conversion.
+        """
+        (entry, self.inflight) = (self.inflight, None)
+        if entry is None:
+            return
+        key = self.get_cache_key()
+        if _inflight.get(key) is entry:
+            del _inflight[key]
+        for waiter in entry["waiters"]:
+            waiter(output)
+
+    def detach_inflight_lock(self):
+        """
+        Returns a function releasing this request's in-flight lock, if it
+        holds one, for stores that finish writing the entry later.  The
+        request no longer releases the lock itself.
+        """
+        (key, self.inflight_lock) = (self.inflight_lock, None)
+        locks = self.get_inflight_locks()
+        if not key or not locks:
+            return None
+        return lambda *args: locks.release(key)
+
+    def release_inflight_lock(self):
+        release = self.detach_inflight_lock()
+        if release:
+            release()
+
+    def on_finish(self):
+        # The request ended without completing its conversion
+        self.share_output(None)
+        self.release_inflight_lock()
+
+    def on_conv_cancelled(self):
+        super(CachingImageHandler, self).on_conv_cancelled()
+        # Let the waiters convert it themselves
+        self.share_output(None)
+        self.release_inflight_lock()
+
+    def cache_metadata(self):
+        """
+        Returns a dict with the "size" and "etag" of the cached entry for this
+        request, or None if they're unknown.  Used to answer HEAD and
+        conditional requests without reading the entry.
+        """
+        return None
+
+    def get_byte_range(self, size):
+        """
+        Returns the (start, end) slice of a cached entry of size bytes asked
+        for by the Range header and sets up the 206 response, or None to send
+        the whole entry.  Unsatisfiable ranges get a 416 and an empty slice.
+        """
+        header = self.request.headers.get("Range")
+        if not header or self.request.method != "GET":
+            return None
+        if_range = self.request.headers.get("If-Range")
+        if if_range and if_range != self._headers.get("Etag"):
+            return None
+        match = _RANGE_RE.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            return None
+
+        (first, last) = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+        else:
+            start = max(size - int(last), 0)
+            end = size
+
+        if start >= end:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            return (0, 0)
+
+        self.set_status(206)
+        self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+        return (start, end)
+
+    def cache_age(self):
+        """
+        Returns the age in seconds of the cached entry for this request, or
+        None if it's unknown.
+        """
+        return None
+
+    def is_stale(self):
+        """
+        Returns True if the cached entry is past its freshness window.
+        """
+        if not self.CACHE_FRESHNESS:
+            return False
+        age = self.cache_age()
+        return age is not None and age > self.CACHE_FRESHNESS
+
+    def get_source(self, *args):
+        """
+        Returns the source (local path or URL) to re-render a stale entry
+        from, given the handler's arguments, or None if it's unknown.  The
+        default only knows the source this process last converted for the
+        cache key, which other processes and nodes sharing the cache, and
+        this one after a restart, don't.  Handlers using CACHE_FRESHNESS
+        should override it, typically with the handler's own source lookup.
+        """
+        return _entry_sources.get(self.get_cache_key())
+
+    def begin_conversion(self, source):
+        """
+        Remembers the source of the entry for get_source().
+        """
+        if self.CACHE_FRESHNESS and source:
+            if len(_entry_sources) >= ENTRY_SOURCES_SIZE:
+                _entry_sources.clear()
+            _entry_sources[self.get_cache_key()] = source
+        return super(CachingImageHandler, self).begin_conversion(source)
+
+    def revalidate(self, *args):
+        """
+        Re-converts this request's source into the cache in the background,
+        after the stale entry has been served, to refresh it.  The handler
+        isn't run again: the source comes from get_source().  Only one
+        re-render per cache key runs at a time.
+        """
+        key = self.get_cache_key()
+        now = time()
+        if now - _revalidating.get(key, 0) < self.REVALIDATE_TIMEOUT:
+            return
+        if len(_revalidating) >= ENTRY_SOURCES_SIZE:
+            for (k, started) in _revalidating.items():
+                if now - started >= self.REVALIDATE_TIMEOUT:
+                    del _revalidating[k]
+        # Also keeps the warning below to once per REVALIDATE_TIMEOUT
+        _revalidating[key] = now
+
+        source = self.get_source(*args)
+        if not source:
+            logger.warning("No source to revalidate %s from, get_source() must be "
+                           "overridden for entries this process didn't convert" % key)
+            stats.incr("revalidations_without_source")
+            return
+
+        logger.debug("revalidating %s from %s" % (key, source))
+        self.revalidating = True
+
+        def _on_prepared(convert):
+            try:
+                if convert:
+                    self.start_conversion(source)
+                else:
+                    self.end_revalidation()
+            except Exception:
+                logger.exception("Revalidating %s failed" % key)
+                self.end_revalidation()
+
+        try:
+            if self.begin_conversion(source):
+                self.prepare_conversion(source, _on_prepared)
+            else:
+                self.end_revalidation()
+        except Exception:
+            logger.exception("Revalidating %s failed" % key)
+            self.end_revalidation()
+
+    def end_revalidation(self):
+        if self.revalidating:
+            self.revalidating = False
+            _revalidating.pop(self.get_cache_key(), None)
+
+    def on_conv_error(self):
+        """
+        Failed re-renders leave the stale entry in place.
+        """
+        if not self.revalidating:
+            super(CachingImageHandler, self).on_conv_error()
+            return
+
+        logger.error("Revalidation failed for %s" % self.request.uri)
+        self.remember_failure()
+        self.end_revalidation()
+
+    def get_routing_key(self):
+        return self.get_cache_key()
+
+    def get_cache_key(self):
+        """
+        Returns the cache key of this request, (request.path)/(filters).(format)
+        normalized to a relative path.
+        """
+        # Build filename from filter chain
+        filename = "base"
+        if len(self.magick.filters) > 0:
+            filename = "+".join(self.magick.filters)
+        if self.identifier:
+            filename += "%s-" % self.identifier
+        if len(filename) + len(self.magick.format) + 1 > 200:
+            # Theoretically want to achieve: filename[:keep_length]+md5(filename)+"."+format == 255.
+            # Temporary file has overhead hence arbitrarily choose limit 200.
+            keep_length = 200 - 32 - 1 - len(self.magick.format)
+            m = md5()
+            tail = filename[keep_length:]
+            if type(tail) == unicode:
+                tail = tail.encode('utf-8')
+            m.update(tail)
+            filename = filename[:keep_length] + m.hexdigest()
+        filename += ".%s" % self.magick.format
+
+        # Build /(request.path)/(filename)
+        relpath = os.path.join('/', self.request.path, filename)
+
+        # Normalize double slashes and dot notation as necessary
+        relpath = os.path.normpath(relpath)
+
+        # Strip leading slash
+        return relpath.lstrip('/')
+
+    def conversion_needed(self):
+        """
+        Conversions run to completion so the cache still gets filled.
+        """
+        return True
 
     def on_conv_chunk_ready(self, chunk):
         """
         Call into write handler on chunk ready.
         """
-        super(CachingImageHandler, self).on_conv_chunk_ready(chunk)
+        if not self.revalidating:
+            super(CachingImageHandler, self).on_conv_chunk_ready(chunk)
+        if self.inflight:
+            self.inflight["chunks"].append(chunk)
         self.on_cache_write(chunk)
 
     def on_conv_complete(self):
         """
         Hook our cache write complete on conversion complete.
         """
-        super(CachingImageHandler, self).on_conv_complete()
+        if self.inflight:
+            self.share_output("".join(self.inflight["chunks"]))
+
+        # Other processes wait for the lock until the entry is cached
+        (lock, self.inflight_lock) = (self.inflight_lock, None)
+        if not self.revalidating:
+            super(CachingImageHandler, self).on_conv_complete()
+        self.inflight_lock = lock
+
         self.on_cache_write_complete()
+        self.end_revalidation()
+        self.release_inflight_lock()
 
     def is_cached(self):
         """
@@ -407,6 +1593,7 @@ class CachingImageHandler(ImageHandler):
         """
         Called if is_cached() returns True.  The Content-Type header will be set
         and self.finish() will be called immediately after this method returns.
+        Implementations that can seek should honour get_byte_range().
         """
         raise NotImplementedError()
 
@@ -439,11 +1626,23 @@ class FileCachingImageHandler(CachingImageHandler):
     CACHE_PATH = '/tmp'
     CREATE_MODE = 0755
 
+    # Writes cache files off the IOLoop (see ectyper.cache.FileCacheWriter).
+    # With None, they're written on the IOLoop as the image is converted.
+    CACHE_WRITER = FileCacheWriter()
+
+    # Stores derivatives of local sources once per source content, under
+    # BLOB_DIR (in CACHE_PATH) by the source's SHA-1 and the filter chain.
+    # Path-keyed cache files are hard links to them, so the same artwork
+    # under many paths is stored once.  Sources are hashed and files linked
+    # by the CACHE_WRITER's thread; without a CACHE_WRITER this is off.
+    CONTENT_ADDRESSED = False
+    BLOB_DIR = "blobs"
+
     def __init__(self, *args, **kwargs):
         super(FileCachingImageHandler, self).__init__(*args, **kwargs)
         self.cache_fd = None
+        self.cache_chunks = []
         self.cacheable = True
-        self.identifier = None
         self.write_path = None
         self.final_path = None
         self.wrote_bytes = 0
@@ -459,48 +1658,161 @@ class FileCachingImageHandler(CachingImageHandler):
 
         return result and result.st_size > 0
 
+    def cache_age(self):
+        try:
+            return time() - os.stat(self.get_cache_name()[1]).st_mtime
+        except OSError:
+            return None
+
+    def cache_metadata(self):
+        try:
+            result = os.stat(self.get_cache_name()[1])
+        except OSError:
+            return None
+        return {"size": result.st_size,
+                "etag": '"%x-%x"' % (int(result.st_mtime * 1000), result.st_size)}
+
+    def conversion_needed(self):
+        return self.cacheable
+
     def on_cache_hit(self):
-        fullpath = self.get_cache_name()[1]
+        self.send_cache_file(self.get_cache_name()[1])
+
+    def send_cache_file(self, fullpath):
+        """
+        Writes the cache file at fullpath, or the requested byte range of it.
+        """
         if os.path.isfile(fullpath):
-            fh = open(fullpath)
-            self.write(fh.read())
-            fh.close()
+            fh = open(fullpath, 'rb')
+            try:
+                byte_range = self.get_byte_range(os.fstat(fh.fileno()).st_size)
+                if byte_range:
+                    (start, end) = byte_range
+                    fh.seek(start)
+                    self.write(fh.read(end - start))
+                else:
+                    self.write(fh.read())
+            finally:
+                fh.close()
         else:
             raise HTTPError(404)
 
     def get_cache_name(self):
-        # Build filename from filter chain
-        filename = "base"
-        if len(self.magick.filters) > 0:
-            filename = "+".join(self.magick.filters)
-        if self.identifier:
-            filename += "%s-" % self.identifier
-        if len(filename) + len(self.magick.format) + 1 > 200:
-            # Theoretically want to achieve: filename[:keep_length]+md5(filename)+"."+format == 255.
-            # Temporary file has overhead hence arbitrarily choose limit 200.
-            keep_length = 200 - 32 - 1 - len(self.magick.format)
-            m = md5()
-            tail = filename[keep_length:]
-            if type(tail) == unicode:
-                tail = tail.encode('utf-8')
-            m.update(tail)
-            filename = filename[:keep_length] + m.hexdigest()
-        filename += ".%s" % self.magick.format
-
-        # Build /(request.path)/(filename)
-        relpath = os.path.join('/', self.request.path, filename)
-
-        # Normalize double slashes and dot notation as necessary
-        relpath = os.path.normpath(relpath)
-
-        # Strip leading slash
-        relpath = relpath.lstrip('/')
+        relpath = self.get_cache_key()
 
         # Generate full path on disk
         fullpath = os.path.realpath(os.path.join(self.CACHE_PATH, relpath))
 
         return (relpath, fullpath)
 
+    def get_blob_path(self, digest):
+        """
+        Returns the path of the content-addressed cache file of this request
+        for a source whose SHA-1 is digest, keyed on it and the cache file's
+        name (filters.format).
+        """
+        filename = os.path.basename(self.get_cache_key())
+        return os.path.join(os.path.realpath(self.CACHE_PATH), self.BLOB_DIR,
+                            digest[:2], digest, filename)
+
+    def content_addressed(self, source):
+        """
+        Returns True if the derivative of source is stored by content.
+        """
+        return self.CONTENT_ADDRESSED and self.CACHE_WRITER and self.cacheable and \
+            source and not is_remote(source) and os.path.isfile(source)
+
+    def prepare_conversion(self, source, callback):
+        """
+        With CONTENT_ADDRESSED, hashes local sources on the CACHE_WRITER's
+        thread first.  Sources whose derivative is already stored under
+        their content are served from that blob, which the CACHE_WRITER
+        links to this request's cache name; the others are converted.
+        """
+        if not self.content_addressed(source) or self.revalidating:
+            super(FileCachingImageHandler, self).prepare_conversion(source, callback)
+            return
+
+        def _on_hash(digest):
+            if self.conversion_abandoned():
+                callback(False)
+                return
+            blob_path = digest and self.get_blob_path(digest)
+            if not blob_path or not os.path.isfile(blob_path):
+                super(FileCachingImageHandler, self).prepare_conversion(source, callback)
+                return
+
+            logger.debug("serving %s from %s" % (source, blob_path))
+            stats.incr("blob_hits")
+            path = self.get_cache_name()[1]
+            self.CACHE_WRITER.call(lambda: self.link_file(blob_path, path), name=path)
+            self.set_content_type()
+            self.send_cache_file(blob_path)
+            self.finish()
+            callback(False)
+
+        digest = known_source_hash(source)
+        if digest:
+            _on_hash(digest)
+            return
+
+        ioloop = IOLoop.current()
+        # Runs in this request's context, so its errors still reach it
+        _on_hash = stack_context.wrap(_on_hash)
+
+        def _hash():
+            digest = None
+            try:
+                digest = hash_source(source)
+            finally:
+                ioloop.add_callback(_on_hash, digest)
+
+        self.CACHE_WRITER.call(_hash, name=source)
+
+    def store_blob(self, source, path, replace=False):
+        """
+        Shares the cache file at path, converted from the local file source,
+        with every path of the same content: links it to the blob, or
+        replaces it with a link to the blob if there is one already (and
+        replace isn't set).  Called from the CACHE_WRITER's thread, as it
+        hashes the source.
+        """
+        if not os.path.isfile(path):
+            # Dropped by the writer
+            return
+        blob_path = self.get_blob_path(hash_source(source))
+        if replace or not os.path.isfile(blob_path):
+            self.link_file(path, blob_path)
+        else:
+            self.link_file(blob_path, path)
+
+    def link_file(self, source, path):
+        """
+        Makes path a hard link to source (or a copy where links fail),
+        replacing any file already there.  Only called from the
+        CACHE_WRITER's thread.
+        """
+        dname = os.path.dirname(path)
+        try:
+            if not os.path.isdir(dname):
+                os.makedirs(dname, mode=self.CREATE_MODE)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
+
+        temp = "%s.link.%d.%d" % (path, time(), randint(0, 10000))
+        try:
+            try:
+                os.link(source, temp)
+            except OSError:
+                shutil.copyfile(source, temp)
+            os.rename(temp, path)
+            stats.incr("blob_links")
+        except (IOError, OSError):
+            logger.exception("Linking %s to %s failed" % (path, source))
+            if os.path.exists(temp):
+                os.remove(temp)
+
     def on_cache_miss(self):
         pass
 
@@ -508,6 +1820,12 @@ class FileCachingImageHandler(CachingImageHandler):
         if not self.cacheable:
             return
 
+        if self.CACHE_WRITER:
+            if chunk:
+                self.cache_chunks.append(chunk)
+                self.wrote_bytes += len(chunk)
+            return
+
         if not self.cache_fd:
             self.final_path = self.get_cache_name()[1]
 
@@ -516,8 +1834,8 @@ class FileCachingImageHandler(CachingImageHandler):
                 self.final_path, time(), randint(0, 10000))
 
             # Open the cache file for writing if the final and write paths do not
-            # yet exist
-            if not os.path.exists(self.final_path) and \
+            # yet exist, or if the final path is being refreshed
+            if (self.revalidating or not os.path.exists(self.final_path)) and \
                     not os.path.exists(self.write_path):
                 dname = os.path.dirname(self.write_path)
 
@@ -541,6 +1859,24 @@ class FileCachingImageHandler(CachingImageHandler):
             self.wrote_bytes += len(chunk)
 
     def on_cache_write_complete(self):
+        if self.cache_chunks:
+            release = self.detach_inflight_lock()
+            path = self.get_cache_name()[1]
+            source = self.source if self.content_addressed(self.source) else None
+            replace = self.revalidating
+
+            def _on_write():
+                try:
+                    if source:
+                        self.store_blob(source, path, replace)
+                finally:
+                    if release:
+                        release()
+            self.CACHE_WRITER.write(path, self.cache_chunks,
+                                    replace=replace, mode=self.CREATE_MODE,
+                                    callback=_on_write)
+            self.cache_chunks = []
+
         if self.cache_fd:
             self.cache_fd.close()
             self.cache_fd = None
@@ -552,3 +1888,169 @@ class FileCachingImageHandler(CachingImageHandler):
                 os.rename(self.write_path, self.final_path)
             else:
                 os.remove(self.write_path)
+
+
+class StoreCachingImageHandler(CachingImageHandler):
+    """
+    Image handler that caches converted images in a CacheStore (see
+    ectyper.cache), e.g. a MemcacheStore shared by every node:
+
+        class SharedImages(StoreCachingImageHandler):
+            CACHE_STORE = MemcacheStore(["cache1:11211", "cache2:11211"])
+    """
+
+    CACHE_STORE = None
+
+    def __init__(self, *args, **kwargs):
+        super(StoreCachingImageHandler, self).__init__(*args, **kwargs)
+        self.cached_value = None
+        self.cached_stat = None
+        self.cache_chunks = []
+
+    def lookup_cache(self, callback):
+        key = self.get_cache_key()
+
+        def _on_get(value):
+            self.cached_value = value
+            self.finish_when_done(callback(value is not None))
+
+        def _on_stat(stat):
+            # HEAD needs only the stat, if the store can give one
+            self.cached_stat = stat
+            if stat and self.request.method == "HEAD":
+                self.finish_when_done(callback(True))
+            else:
+                self.CACHE_STORE.get(key, _on_get)
+
+        self.CACHE_STORE.stat(key, _on_stat)
+
+    def is_cached(self):
+        return self.cached_value is not None or self.cached_stat is not None
+
+    def cache_age(self):
+        """
+        Uses the timestamp from the store's stat(), if it gives one.
+        """
+        if self.cached_stat:
+            return time() - self.cached_stat[1]
+        return None
+
+    def cache_metadata(self):
+        if self.cached_stat:
+            (length, timestamp) = self.cached_stat
+            return {"size": length, "etag": '"%x-%x"' % (int(timestamp * 1000), length)}
+        if self.cached_value is not None:
+            return {"size": len(self.cached_value),
+                    "etag": '"%s"' % md5(self.cached_value).hexdigest()}
+        return None
+
+    def on_cache_hit(self):
+        byte_range = self.get_byte_range(len(self.cached_value))
+        if byte_range:
+            (start, end) = byte_range
+            self.write(self.cached_value[start:end])
+        else:
+            self.write(self.cached_value)
+
+    def on_cache_miss(self):
+        pass
+
+    def on_cache_write(self, chunk):
+        self.cache_chunks.append(chunk)
+
+    def on_cache_write_complete(self):
+        if self.cache_chunks:
+            value = "".join(self.cache_chunks)
+            self.cache_chunks = []
+            self.CACHE_STORE.set(self.get_cache_key(), value, self.detach_inflight_lock())
+
+
+class StatsHandler(RequestHandler):
+    """
+    Serves ectyper's counters and gauges, and the most frequent items of its
+    heavy hitter tables, as JSON:
+
+        {"values": {"conversions_cancelled": 3, ...},
+         "top": {"cache_keys": [[key, count, error], ...], ...}}
+
+    The top argument sets how many items of each table are listed, 0 for
+    all of them.  Only clients from ALLOWED_IPS may read them: the tables
+    list the paths and sources being requested.
+    """
+
+    ALLOWED_IPS = ("127.0.0.1", "::1")
+    DEFAULT_TOP = 20
+
+    def get(self):
+        if self.request.remote_ip not in self.ALLOWED_IPS:
+            raise HTTPError(403)
+        try:
+            n = int(self.get_argument("top", self.DEFAULT_TOP))
+        except ValueError:
+            raise HTTPError(400)
+        self.set_header("Cache-Control", "no-cache")
+        self.write({"values": stats.snapshot(), "top": stats.top_snapshot(max(n, 0) or None)})
+
+
+class ProfileHandler(RequestHandler):
+    """
+    Profiles the process by sampling thread stacks (see
+    ectyper.monitor.sample_stacks) for the given number of seconds, then
+    returns them as collapsed stacks for flamegraph.pl:
+
+        curl "localhost:8888/admin/profile?seconds=30" | flamegraph.pl > cpu.svg
+
+    Only the IOLoop's thread is sampled unless all=1.  interval is the
+    sampling period in milliseconds.  Sampling runs in a background thread
+    and only while asked to, one profile at a time (409 otherwise).  Only
+    clients from ALLOWED_IPS may profile.
+    """
+
+    ALLOWED_IPS = ("127.0.0.1", "::1")
+    DEFAULT_SECONDS = 10
+    MAX_SECONDS = 60
+    DEFAULT_INTERVAL = 5
+
+    def initialize(self):
+        self.client_closed = False
+
+    @asynchronous
+    def get(self):
+        if self.request.remote_ip not in self.ALLOWED_IPS:
+            raise HTTPError(403)
+        try:
+            seconds = float(self.get_argument("seconds", self.DEFAULT_SECONDS))
+            interval = float(self.get_argument("interval", self.DEFAULT_INTERVAL)) / 1000
+        except ValueError:
+            raise HTTPError(400)
+        if seconds <= 0 or interval <= 0:
+            raise HTTPError(400)
+        seconds = min(seconds, self.MAX_SECONDS)
+        thread_ids = None if self.get_argument("all", "0") == "1" else [get_ident()]
+
+        ioloop = IOLoop.current()
+
+        def _sample():
+            counts = None
+            try:
+                counts = monitor.sample_stacks(seconds, interval, thread_ids)
+            finally:
+                ioloop.add_callback(self.on_profile, counts)
+
+        sampler = Thread(target=_sample, name="ectyper-profiler")
+        sampler.daemon = True
+        sampler.start()
+
+    def on_profile(self, counts):
+        if self.client_closed:
+            return
+        if counts is None:
+            self.send_error(409)
+            return
+        self.set_header("Content-Type", "text/plain")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(monitor.format_collapsed(counts))
+        self.finish()
+
+    def on_connection_close(self):
+        self.client_closed = True
@@ -0,0 +1,356 @@
+"""
+Replays traffic against a running ectyper server and reports on it.
+
+URLs come from an access log (common or combined format, the request line
+is used) or a list of URLs or paths, one per line.  They're replayed
+against --target either in order, cycling, or sampled with Zipf skew
+(--zipf=s), URLs ranked by how often they appear:
+
+    python loadgen.py --urls=access.log --target=http://localhost:8888 \\
+        --concurrency=32 --duration=60 --zipf=1.1 --pid=12345
+
+--concurrency keeps that many requests in flight (closed loop); --rate
+sends that many requests per second whatever the response times are (open
+loop).  Every --interval seconds the throughput, latency percentiles and
+RSS of --pid and its children (from /proc) are printed.  At the end the
+cache hit ratio and the number of processes forked are read from the
+server's StatsHandler (--stats_path), when it has one.
+
+--origin_port starts a stand-in origin serving --origin_image for every
+path, after --origin_latency milliseconds, so remote sources can be pointed
+at http://localhost:<origin_port>/ instead of the real origin.
+"""
+from bisect import bisect
+import json
+import mimetypes
+import os
+import random
+import re
+import sys
+from time import time
+from urlparse import urlparse
+
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+# The request line of a common/combined log format entry
+_REQUEST_RE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[\d.]+"')
+
+
+def read_urls(path):
+    """
+    Returns the paths (with query strings) listed in the access log or URL
+    list at path, in order.
+    """
+    urls = []
+    fh = open(path)
+    try:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            match = _REQUEST_RE.search(line)
+            if match:
+                url = match.group(1)
+            elif '"' in line:
+                # Log entry of another method
+                continue
+            else:
+                url = line.split()[0]
+            parsed = urlparse(url)
+            urls.append(parsed.path + ("?" + parsed.query if parsed.query else ""))
+    finally:
+        fh.close()
+    return urls
+
+
+def replay(urls):
+    """
+    Yields urls in order, over and over.
+    """
+    while True:
+        for url in urls:
+            yield url
+
+
+def zipf(urls, s, rng=random):
+    """
+    Yields urls at random with Zipf skew s: the k-th most frequent URL of
+    the list is picked with a probability proportional to 1 / k ** s.
+    """
+    counts = {}
+    order = []
+    for url in urls:
+        if url not in counts:
+            order.append(url)
+        counts[url] = counts.get(url, 0) + 1
+    ranked = sorted(order, key=lambda url: -counts[url])
+
+    cumulative = []
+    total = 0.0
+    for rank in xrange(1, len(ranked) + 1):
+        total += 1.0 / rank ** s
+        cumulative.append(total)
+    while True:
+        yield ranked[min(bisect(cumulative, rng.random() * total), len(ranked) - 1)]
+
+
+def rss_kb(pid):
+    """
+    Returns the resident memory in KB of pid and its children, or None if
+    it can't be read from /proc.
+    """
+    pids = set([pid])
+    try:
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                fh = open("/proc/%s/stat" % name)
+                try:
+                    fields = fh.read().rsplit(")", 1)[1].split()
+                finally:
+                    fh.close()
+            except (IOError, IndexError):
+                continue
+            if int(fields[1]) == pid:
+                pids.add(int(name))
+    except OSError:
+        return None
+
+    total = 0
+    for child in pids:
+        try:
+            fh = open("/proc/%d/status" % child)
+            try:
+                for line in fh:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            finally:
+                fh.close()
+        except IOError:
+            if child == pid:
+                return None
+    return total
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (0..100) of the sorted list values.
+    """
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class OriginHandler(web.RequestHandler):
+    """
+    Stand-in origin serving the same image for every path.
+    """
+
+    def initialize(self, data, content_type, latency):
+        self.data = data
+        self.content_type = content_type
+        self.latency = latency
+
+    @web.asynchronous
+    def get(self, *args):
+        IOLoop.current().add_timeout(time() + self.latency, self.respond)
+
+    def respond(self):
+        self.set_header("Content-Type", self.content_type)
+        self.write(self.data)
+        self.finish()
+
+
+class LoadGenerator(object):
+    """
+    Sends the URLs yielded by urls to target, either keeping concurrency
+    requests in flight or at rate requests per second, until duration
+    seconds have passed or requests requests were sent.  Latencies and
+    status codes are kept in results as (time, seconds, code) tuples.
+    """
+
+    def __init__(self, target, urls, concurrency=None, rate=None, duration=None,
+                 requests=None, timeout=30, ioloop=None):
+        self.target = target.rstrip("/")
+        self.urls = urls
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.ioloop = ioloop or IOLoop.current()
+        self.client = AsyncHTTPClient()
+        self.results = []
+        self.sent = 0
+        self.in_flight = 0
+        self.start = None
+        self.done = None
+
+    def run(self, callback):
+        """
+        Starts sending requests, calls callback once they're all answered.
+        """
+        self.start = time()
+        self.done = callback
+        if self.rate:
+            self._send_scheduled()
+        else:
+            for _ in xrange(self.concurrency or 1):
+                self._send_next()
+
+    def finished_sending(self):
+        return (self.requests and self.sent >= self.requests) or \
+            (self.duration and time() - self.start >= self.duration)
+
+    def _send_next(self):
+        if self.finished_sending():
+            self._check_done()
+            return False
+        self.sent += 1
+        self.in_flight += 1
+        started = time()
+        self.client.fetch(HTTPRequest(self.target + next(self.urls), request_timeout=self.timeout),
+                          callback=lambda response: self._on_response(started, response))
+        return True
+
+    def _send_scheduled(self):
+        # Sends every request due by now, keeping to the schedule when the
+        # IOLoop falls behind
+        while self.sent < (time() - self.start) * self.rate:
+            if not self._send_next():
+                return
+        self.ioloop.add_timeout(self.start + (self.sent + 1) / float(self.rate), self._send_scheduled)
+
+    def _on_response(self, started, response):
+        now = time()
+        self.in_flight -= 1
+        self.results.append((now, now - started, response.code))
+        if not self.rate:
+            self._send_next()
+        self._check_done()
+
+    def _check_done(self):
+        if self.in_flight == 0 and self.finished_sending() and self.done:
+            (done, self.done) = (self.done, None)
+            done()
+
+
+def fetch_stats(url, callback):
+    """
+    Calls callback with the values served by the StatsHandler at url, or
+    an empty dict.
+    """
+    def _on_response(response):
+        try:
+            callback(json.loads(response.body)["values"] if not response.error else {})
+        except (ValueError, KeyError, TypeError):
+            callback({})
+    AsyncHTTPClient().fetch(url, callback=_on_response)
+
+
+def report_interval(generator, since, pid):
+    now = time()
+    window = sorted(seconds for (at, seconds, _) in generator.results if at > since)
+    rss = rss_kb(pid) if pid else None
+    print "%7.1fs %8.1f req/s  p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  rss %s" % (
+        now - generator.start, len(window) / max(now - since, 1e-6),
+        percentile(window, 50) * 1000, percentile(window, 90) * 1000,
+        percentile(window, 99) * 1000, "%dKB" % rss if rss is not None else "-")
+    sys.stdout.flush()
+
+
+def report_total(generator, before, after):
+    elapsed = (generator.results[-1][0] if generator.results else time()) - generator.start
+    latencies = sorted(seconds for (_, seconds, _) in generator.results)
+    errors = len([code for (_, _, code) in generator.results if code not in (200, 206, 304)])
+    print
+    print "requests  %d in %.1fs, %.1f req/s, %d errors" % (
+        len(latencies), elapsed, len(latencies) / max(elapsed, 1e-6), errors)
+    print "latency   p50 %.1fms  p90 %.1fms  p99 %.1fms  p99.9 %.1fms  max %.1fms" % tuple(
+        percentile(latencies, p) * 1000 for p in (50, 90, 99, 99.9, 100))
+
+    delta = lambda name: after.get(name, 0) - before.get(name, 0)
+    lookups = delta("cache_hits") + delta("cache_misses")
+    if after:
+        print "cache     %.1f%% hits (%d of %d lookups)" % (
+            100.0 * delta("cache_hits") / lookups if lookups else 0, delta("cache_hits"), lookups)
+        print "forks     %d processes, %.2f per request" % (
+            delta("processes_forked"), delta("processes_forked") / float(max(len(latencies), 1)))
+    else:
+        print "cache     - (no stats at --stats_path)"
+
+
+def main():
+    define("urls", type=str, help="Access log or list of URLs to replay")
+    define("target", type=str, default="http://localhost:8888", help="Server to replay against")
+    define("concurrency", type=int, default=16, help="Requests kept in flight (closed loop)")
+    define("rate", type=float, default=None, help="Requests per second (open loop), overrides concurrency")
+    define("duration", type=float, default=60, help="Seconds to run for")
+    define("requests", type=int, default=None, help="Number of requests to send, overrides duration")
+    define("zipf", type=float, default=None, help="Sample URLs with this Zipf skew instead of replaying them in order")
+    define("seed", type=int, default=None, help="Random seed for --zipf")
+    define("timeout", type=float, default=30, help="Request timeout in seconds")
+    define("interval", type=float, default=5, help="Seconds between progress reports")
+    define("pid", type=int, default=None, help="Server process whose RSS (with its children) is reported")
+    define("stats_path", type=str, default="/stats", help="Path of the server's StatsHandler")
+    define("origin_port", type=int, default=None, help="Port of the stand-in origin, none if unset")
+    define("origin_image", type=str, default="images/hulu.jpg", help="Image served by the stand-in origin")
+    define("origin_latency", type=float, default=0, help="Milliseconds the stand-in origin waits before answering")
+    parse_command_line()
+
+    if not options.urls:
+        print >>sys.stderr, "--urls is required"
+        sys.exit(2)
+    urls = read_urls(options.urls)
+    if not urls:
+        print >>sys.stderr, "no URLs in %s" % options.urls
+        sys.exit(2)
+    sequence = zipf(urls, options.zipf, random.Random(options.seed)) if options.zipf else replay(urls)
+
+    AsyncHTTPClient.configure(None, max_clients=max(options.concurrency, 1000 if options.rate else 0))
+    ioloop = IOLoop.current()
+
+    if options.origin_port:
+        fh = open(options.origin_image, 'rb')
+        try:
+            data = fh.read()
+        finally:
+            fh.close()
+        content_type = mimetypes.guess_type(options.origin_image)[0] or "application/octet-stream"
+        web.Application([(r"/(.*)", OriginHandler, {
+            "data": data, "content_type": content_type, "latency": options.origin_latency / 1000.0,
+        })]).listen(options.origin_port)
+
+    generator = LoadGenerator(options.target, sequence,
+                              concurrency=options.concurrency, rate=options.rate,
+                              duration=None if options.requests else options.duration,
+                              requests=options.requests, timeout=options.timeout)
+    stats_url = options.target.rstrip("/") + options.stats_path
+    state = {"before": {}, "since": None}
+
+    def _report():
+        report_interval(generator, state["since"], options.pid)
+        state["since"] = time()
+        if generator.done:
+            ioloop.add_timeout(time() + options.interval, _report)
+
+    def _on_after(after):
+        report_total(generator, state["before"], after)
+        ioloop.stop()
+
+    def _on_before(before):
+        state["before"] = before
+        state["since"] = time()
+        generator.run(lambda: fetch_stats(stats_url, _on_after))
+        ioloop.add_timeout(time() + options.interval, _report)
+
+    fetch_stats(stats_url, _on_before)
+    ioloop.start()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,72 @@
 from binascii import crc32
-from errno import ESRCH
+from collections import deque, namedtuple
+from errno import EAGAIN, ECHILD, EEXIST, EINTR, ESRCH, EWOULDBLOCK
 from fcntl import fcntl, F_GETFL, F_SETFL
+from hashlib import md5
 import logging
 import os.path
+import re
 from os import O_NONBLOCK
 from subprocess import Popen, PIPE
+from threading import Thread
+from ectyper import dither, stats
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 from urlparse import urlparse
 
 # Text 'stylesheets'
-__all__ = ["ImageMagick", "is_remote"]
+__all__ = ["ImageMagick", "ImageInfo", "ConversionStream", "ConversionError",
+           "ConversionCancelled", "is_remote"]
 
 logger = logging.getLogger("ectyper")
 
+# Source metadata as reported by identify.  format is lower cased to match
+# ImageMagick.JPEG/PNG, profiles holds the names of embedded profiles (exif,
+# icc, xmp...) and comment the image's comment, if any.
+ImageInfo = namedtuple("ImageInfo",
+                       ["width", "height", "format", "colorspace", "alpha", "depth",
+                        "profiles", "comment"])
+
+# Probed source metadata keyed on (path, mtime, size)
+_source_info_cache = {}
+SOURCE_INFO_CACHE_SIZE = 10000
+
+# Text layers being rendered, mapped to their convert process
+_text_layer_renders = {}
+TEXT_LAYER_RENDERS = 4
+
+# Bytes read from convert's output at a time, and reads per IOLoop event
+READ_SIZE = 256 * 1024
+READS_PER_EVENT = 16
+
+_GEOMETRY_RE = re.compile(r'^(\d+)x(\d+)([+-]\d+)([+-]\d+)$')
+
+# Settings (as opposed to operators) that only affect subsequent operators,
+# re-setting one to its current value is a no-op.
+_SETTINGS = set([
+    '-gravity', '-background', '-compose', '-fill', '-font', '-pointsize',
+    '-weight', '-style', '-quality', '-depth', '-sampling-factor', '-filter'
+])
+
+# Number of arguments taken by the operators this module emits
+_ARITY = {
+    '-alpha': 1, '-blur': 1, '-brightness-contrast': 1, '-channel': 1,
+    '-clone': 1, '-colorspace': 1, '-contrast-stretch': 1, '-crop': 1,
+    '-define': 1, '-delete': 1, '-draw': 1, '-extent': 1, '-extract': 1,
+    '-fx': 1, '-geometry': 1, '-limit': 2, '-remap': 1,
+    '-resize': 1, '-set': 2, '-splice': 1, '-thumbnail': 1, '-type': 1,
+}
+
+# Operators that leave the colorspace of an sRGB image untouched
+_SRGB_SAFE = set([
+    '+repage', '-alpha', '-blur', '-brightness-contrast', '-contrast-stretch',
+    '-crop', '-draw', '-equalize', '-extent', '-flip', '-geometry',
+    '-normalize', '-quiet', '-resize', '-splice', '-strip', '-thumbnail',
+])
+
+_TRANSPARENT = set(['transparent', 'none', '#00000000'])
+
 
 def is_remote(path):
     """
@@ -57,6 +111,49 @@ def _non_blocking_fileno(fh):
     return fd
 
 
+def _read_chunks(fd, limit=None):
+    """
+    Reads what's available from fd in chunks of up to READ_SIZE, at most
+    limit of them (default until EOF).  os.read() reads straight into each
+    chunk's string, where file.read() copies as its buffer grows.  Returns
+    (chunks, True if EOF was reached).
+    """
+    chunks = []
+    while limit is None or len(chunks) < limit:
+        try:
+            chunk = os.read(fd, READ_SIZE)
+        except OSError, e:
+            if e.errno == EINTR:
+                continue
+            if e.errno in (EAGAIN, EWOULDBLOCK):
+                return (chunks, False)
+            raise
+        if not chunk:
+            return (chunks, True)
+        chunks.append(chunk)
+    return (chunks, False)
+
+
+def _parse_identify(returncode, output):
+    """
+    Returns the ImageInfo described by the output of ImageMagick.identify's
+    command, or None if identify failed.
+    """
+    (line, _, comment) = output.partition("\n")
+    fields = line.split()
+    if returncode != 0 or len(fields) < 6:
+        return None
+
+    try:
+        return ImageInfo(int(fields[0]), int(fields[1]), fields[2].lower(),
+                         fields[3], fields[4].lower() not in ('false', 'undefined'),
+                         int(fields[5]),
+                         tuple(name for name in "".join(fields[6:]).lower().split(",") if name),
+                         comment)
+    except ValueError:
+        return None
+
+
 def _make_blocking(fd):
     try:
         flags = fcntl(fd, F_GETFL)
@@ -74,6 +171,97 @@ def _list_prepend(dest, src):
         dest.insert(0, src[len(src) - i - 1])
 
 
+def _find_sublist(haystack, needle, start=0):
+    """
+    Returns the index of the first occurrence of the needle list in the
+    haystack list at or after start, or -1 if it's not present.
+    """
+    n = len(needle)
+    for i in xrange(start, len(haystack) - n + 1):
+        if haystack[i:i + n] == needle:
+            return i
+    return -1
+
+
+def _parse_geometry(geometry):
+    """
+    Parses a 'WxH+X+Y' geometry into a 4-tuple of ints, or None if it doesn't
+    match (i.e. percentages).
+    """
+    m = _GEOMETRY_RE.match(geometry)
+    if not m:
+        return None
+    return tuple(map(int, m.groups()))
+
+
+def _optimize_options(tokens):
+    """
+    Returns a copy of the convert options in tokens without operations that
+    can't change the output:
+     - settings re-set to the value they already have,
+     - +repage when the page geometry is already reset,
+     - an -extent to the exact size of the preceding forced (!) resize,
+     - -colorspace sRGB when the image was already converted to sRGB.
+    Settings state is forgotten at parentheses, so nothing inside or across
+    them is removed based on state from the other side.
+    """
+    result = []
+    settings = {}
+    depth = 0
+    page_reset = False
+    srgb = False
+    resized = None
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        nargs = 1 if token in _SETTINGS else _ARITY.get(token, 0)
+        args = tokens[i + 1:i + 1 + nargs]
+        i += 1 + nargs
+        drop = False
+        setting = token in _SETTINGS or \
+            (token.startswith('+') and '-' + token[1:] in _SETTINGS)
+
+        if token in _SETTINGS:
+            drop = settings.get(token) == args
+            settings[token] = args
+        elif setting:
+            settings.pop('-' + token[1:], None)
+        elif token in ('(', ')'):
+            depth += 1 if token == '(' else -1
+            settings = {}
+            page_reset = srgb = False
+            resized = None
+        elif token == '+repage':
+            drop = page_reset
+            page_reset = True
+        elif token == '-colorspace' and args == ['sRGB'] and depth == 0:
+            drop = srgb
+            srgb = True
+        elif token == '-extent' and resized is not None and args == [resized] and \
+                settings.get('-background', [None])[0] in _TRANSPARENT and \
+                settings.get('-compose', ['over'])[0].lower() == 'over':
+            # Same size extent only resets the page, as +repage does
+            token = '+repage'
+            args = []
+            drop = page_reset
+            page_reset = True
+
+        if not setting and token != '+repage':
+            page_reset = False
+            if token not in _SRGB_SAFE and not (token == '-colorspace' and args == ['sRGB']):
+                srgb = False
+            resized = None
+            if token in ('-resize', '-thumbnail') and args[0].endswith('!'):
+                resized = args[0][:-1]
+
+        if not drop:
+            result.append(token)
+            result.extend(args)
+
+    return result
+
+
 def _proc_terminate(proc):
     try:
         if proc.poll() is None:
@@ -84,6 +272,57 @@ def _proc_terminate(proc):
             raise
 
 
+class ConversionError(Exception):
+    """
+    Raised by the coroutine API when a conversion fails.
+    """
+
+
+class ConversionCancelled(ConversionError):
+    """
+    Raised by the coroutine API when a conversion was cancelled.
+    """
+
+
+class _Process(Popen):
+    """
+    Popen that reaps its child with wait4, so the child's resource usage
+    (CPU time, peak RSS) is available as rusage once it has exited.  Each
+    one started counts in the processes_forked stat.
+    """
+    rusage = None
+
+    def __init__(self, *args, **kwargs):
+        Popen.__init__(self, *args, **kwargs)
+        stats.incr("processes_forked")
+
+    def _reap(self, options):
+        try:
+            (pid, status, rusage) = os.wait4(self.pid, options)
+        except OSError, e:
+            if e.errno == EINTR:
+                return
+            if e.errno != ECHILD:
+                raise
+            # Reaped elsewhere, usage is unknown
+            self.returncode = 0
+            return
+
+        if pid == self.pid:
+            self.rusage = rusage
+            self._handle_exitstatus(status)
+
+    def poll(self):
+        if self.returncode is None:
+            self._reap(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self._reap(0)
+        return self.returncode
+
+
 class ImageMagick(object):
     """
     Wraps the command-line verison of ImageMagick and provides a way to:
@@ -107,6 +346,15 @@ class ImageMagick(object):
         "bottomright": "SouthEast",
     }
 
+    # Cost multipliers of expensive operations for estimate_cost(), by
+    # filter name prefix.  reflect runs -fx over every pixel.
+    OP_COSTS = {
+        "reflect_": 8.0,
+        "blur_": 4.0,
+        "rgb555_dither": 3.0,
+    }
+    DEFAULT_PIXELS = 1000000
+
     def __init__(self):
         ""
         self.options = []
@@ -114,8 +362,24 @@ class ImageMagick(object):
         self.format = self.PNG
         self.convert_path = None
         self.curl_path = None
-        self.ioloop = IOLoop.instance()
+        self.identify_path = None
+        self.optimize = True
+        self.thumbnail_factor = None
+        self.thumbnail_filter = None
+        self.rusage = None
+        # Which step of the last conversion failed: "curl", "convert" or
+        # "pixel_stage"
+        self.failed_process = None
+        self.ioloop = IOLoop.current()
         self.comment = '\'\''
+        self.text_layer_dir = None
+        self.text_layers = []
+        self.input_options = []
+        self.read_region = None
+        self.tiles = 1
+        self.pixel_stage = None
+        self._ops = []
+        self._cancel = None
 
     def _chain_op(self, name, operation, prepend):
         """
@@ -124,11 +388,34 @@ class ImageMagick(object):
         """
         if prepend:
             self.filters.insert(0, name)
+            self._ops.insert(0, (name, operation))
             _list_prepend(self.options, operation)
         else:
             self.filters.append(name)
+            self._ops.append((name, operation))
             self.options.extend(operation)
 
+    def _replace_op(self, index, operation):
+        """
+        Private helper.  Replaces the tokens of the index'th chained operation
+        in the options, or removes them if operation is None.  The filter name
+        is kept so that names derived from the filter chain (i.e. cache names)
+        don't change.
+        """
+        start = 0
+        for (i, (name, current)) in enumerate(self._ops):
+            pos = _find_sublist(self.options, current, start)
+            if pos < 0:
+                return
+            if i == index:
+                self.options[pos:pos + len(current)] = operation or []
+                if operation is None:
+                    del self._ops[i]
+                else:
+                    self._ops[i] = (name, operation)
+                return
+            start = pos + len(current)
+
     def reflect(self, out_height, top_alpha, bottom_alpha, prepend=False):
         """
         Flip the image upside down and crop to the last out_height pixels.  Top
@@ -206,11 +493,45 @@ class ImageMagick(object):
                           str(style['font_weight']))
 
     def add_text(self, x, y, g, pointsize, color, text, font, font_weight, style="Normal", prepend=False):
+        """
+        Draws text at offset (x, y) from gravity g.  With a text_layer_dir,
+        text is composited from a transparent image of the rendered text
+        instead, once that exists; until then it's drawn and the layer is
+        rendered in the background by the next convert().
+        """
         stripped_text = ''.join(c for c in text if c.isalnum())
         stripped_text = stripped_text[:64] if len(stripped_text) > 64 else stripped_text
         check = crc32(text.encode('utf-8'))
+        name = 'text_%s%s%s_%s_%s' % (g, x, y, stripped_text, check)
+
+        layer = None
+        if self.text_layer_dir:
+            key = "\0".join([pointsize, color, font or "", font_weight, style, text])
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            layer = os.path.join(self.text_layer_dir, "%s.png" % md5(key).hexdigest())
+
+        if layer and os.path.isfile(layer):
+            geometry = "%+d%+d" % (int(round(float(x))), int(round(float(y))))
+            self._chain_op(name, [layer, "-gravity", g, "-geometry", geometry, "-composite"],
+                           prepend)
+            return
+
+        if layer:
+            # Escape percent escapes and @file references of label:
+            label = text.replace('%', '%%')
+            if label.startswith('@'):
+                label = '\\' + label
+            self.text_layers.append((layer, [
+                "-background", "none",
+                "-pointsize", pointsize,
+                "-fill", color,
+                "-weight", font_weight,
+                "-style", style,
+            ] + (["-font", font] if font else []) + ["label:" + label]))
+
         self._chain_op(
-            'text_%s%s%s_%s_%s' % (g, x, y, stripped_text, check),
+            name,
             [
                 "-gravity", g,
                 "-pointsize", pointsize,
@@ -223,6 +544,52 @@ class ImageMagick(object):
             prepend
         )
 
+    def render_text_layers(self):
+        """
+        Starts rendering the text layers that add_text() had to draw instead,
+        in the background.  Layers are written to a temporary file and moved
+        into text_layer_dir when done.
+        """
+        for (layer, options) in self.text_layers:
+            if layer in _text_layer_renders or os.path.exists(layer) or \
+                    len(_text_layer_renders) >= TEXT_LAYER_RENDERS:
+                continue
+
+            try:
+                os.makedirs(os.path.dirname(layer))
+            except OSError, e:
+                if e.errno != EEXIST:
+                    raise
+
+            temp = "%s.%d.tmp" % (layer, os.getpid())
+            command = ['convert' if not self.convert_path else self.convert_path] + \
+                options + ['PNG32:' + temp]
+            logger.debug("RENDER text layer %s COMMAND %s" % (layer, command))
+            devnull = open(os.devnull, 'w')
+            try:
+                _text_layer_renders[layer] = _Process(
+                    [o.encode('utf-8') if isinstance(o, unicode) else o for o in command],
+                    stdout=devnull, stderr=devnull, close_fds=True)
+            finally:
+                devnull.close()
+            self._check_text_layer(layer, temp)
+        self.text_layers = []
+
+    def _check_text_layer(self, layer, temp):
+        proc = _text_layer_renders[layer]
+        if proc.poll() is None:
+            self.ioloop.add_timeout(self.ioloop.time() + 0.1,
+                                    lambda: self._check_text_layer(layer, temp))
+            return
+
+        del _text_layer_renders[layer]
+        if proc.returncode == 0 and os.path.isfile(temp):
+            os.rename(temp, layer)
+        else:
+            logger.warning("Rendering text layer %s failed" % layer)
+            if os.path.exists(temp):
+                os.remove(temp)
+
     def overlay(self, x, y, g, image_filename, prepend=False):
         """
         Overlay without resizing
@@ -256,13 +623,18 @@ class ImageMagick(object):
             ],
             prepend)
 
-    def resize(self, w, h, maintain_ratio, will_crop, prepend=False):
+    def resize(self, w, h, maintain_ratio, will_crop, prepend=False,
+               thumbnail=False, resample_filter=None):
         """
         Resizes the image to the given size.  w and h are expected to be
         positive integers.  If maintain_ratio evaluates to True, the original
         aspect ratio of the image will be preserved. With maintain_ratio True:
         if will_crop is true, then the result will fill and possibly overflow
         the dimensions; otherwise it will scale to fit inside the dimensions.
+
+        If thumbnail is True, -thumbnail is used instead of -resize, which is
+        faster for large reductions and drops profiles and other metadata.
+        resample_filter optionally names the -filter used for the resize.
         """
 
         resize_type = 1
@@ -275,8 +647,17 @@ class ImageMagick(object):
             resize_type = 2
 
         name = 'resize_%d_%d_%d' % (w, h, resize_type)
-        opt = ['-resize', size]
-        self._chain_op(name, opt, prepend)
+        self._chain_op(name, self._resize_op(size, thumbnail, resample_filter), prepend)
+
+    def _resize_op(self, size, thumbnail, resample_filter):
+        """
+        Private helper.  Returns the options for a resize to size.
+        """
+        opt = ['-thumbnail' if thumbnail else '-resize', size]
+        if resample_filter:
+            # Don't leak the filter into later operations (i.e. overlays)
+            opt = ['-filter', resample_filter] + opt + ['+filter']
+        return opt
 
     def set_quality(self, quality):
         """
@@ -376,11 +757,20 @@ class ImageMagick(object):
         opt = ['-brightness-contrast', brightness_and_contrast]
         self._chain_op(name, opt, prepend)
 
-    def rgb555_dither(self, _colormap=None):
+    def rgb555_dither(self, _colormap=None, method=None):
         """
         Reduce color channels to 5-bit by dithering, preserving Alpha channel.
         Intented for better look on 16-bit screens.
+
+        With method (one of ectyper.dither.METHODS) and NumPy available, PNGs
+        are dithered by ectyper.dither on the decoded pixels, after the rest
+        of the chain, instead of by convert's -remap.
         """
+        if method in dither.METHODS and dither.available():
+            self.pixel_stage = lambda pixels: dither.rgb555(pixels, method)
+            self._chain_op('rgb555_dither_%s' % method, [], False)
+            return
+
         name = 'rgb555_dither'
         if _colormap is None:
             _colormap = os.path.dirname(__file__) + "/gs5bit.png"
@@ -424,6 +814,267 @@ class ImageMagick(object):
         if isinstance(name, basestring) and isinstance(params, list):
             self._chain_op(name, params, prepend)
 
+    def sprite_sheet(self, paths, w, h, columns, background='none'):
+        """
+        Turns the chain into one that runs against each of the local images
+        in paths, centers every result on a w x h cell filled with background,
+        and lays the cells out left to right, columns per row.  The sheet is
+        rendered by convert(None), in one process.  Call this last: the chain
+        can't be planned or changed afterwards.
+        """
+        cell = ['-gravity', 'Center', '-background', background, '-extent', '%dx%d' % (w, h)]
+        options = ['-respect-parentheses']
+        for start in xrange(0, len(paths), columns):
+            options.append('(')
+            for path in paths[start:start + columns]:
+                options.extend(['(', path] + self.options + cell + [')'])
+            options.extend(['+append', ')'])
+        self.options = options + ['-background', background, '-append']
+
+        check = crc32("\0".join(p.encode('utf-8') if isinstance(p, unicode) else p
+                                for p in paths))
+        self.filters.append('sprite_%d_%d_%d_%s_%s' % (w, h, columns, background, check))
+        self.tiles = len(paths)
+
+    def identify(self, path, callback=None):
+        """
+        Runs identify against the first frame of the local image at path and
+        returns an ImageInfo, or None if the image can't be read.  Only the
+        header is inspected (-ping).  Without a callback this blocks while
+        identify runs; with one, identify's output is read on the ioloop
+        and callback is called with the result.
+        """
+        command = [
+            'identify' if not self.identify_path else self.identify_path,
+            '-quiet', '-ping',
+            '-format', '%w %h %m %[colorspace] %A %z %[profiles]\\n%c',
+            path + '[0]'
+        ]
+        devnull = open(os.devnull, 'w')
+        try:
+            proc = _Process(command, stdout=PIPE, stderr=devnull, close_fds=True)
+        except OSError, e:
+            logger.warning("Couldn't run identify: %s" % str(e))
+            proc = None
+        finally:
+            devnull.close()
+
+        if not callable(callback):
+            if not proc:
+                return None
+            output = proc.communicate()[0]
+            return _parse_identify(proc.returncode, output)
+
+        if not proc:
+            callback(None)
+            return
+        chunks = []
+
+        def _on_read(fd, events):
+            (data, eof) = _read_chunks(fd, READS_PER_EVENT)
+            chunks.extend(data)
+            if eof:
+                self.ioloop.remove_handler(fd)
+                proc.stdout.close()
+                # The output is complete, identify is exiting
+                proc.wait()
+                callback(_parse_identify(proc.returncode, "".join(chunks)))
+
+        self.ioloop.add_handler(_non_blocking_fileno(proc.stdout), _on_read, IOLoop.READ)
+
+    def probe(self, path, callback=None):
+        """
+        Returns the ImageInfo for the local image at path, or calls callback
+        with it once identify is done without blocking (see identify()).
+        Results are cached per (path, mtime, size) so each source is
+        identified once until it changes on disk.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+
+        key = st and (path, st.st_mtime, st.st_size)
+        info = key and _source_info_cache.get(key)
+        if not key or info is not None:
+            if not callable(callback):
+                return info
+            callback(info)
+            return
+
+        def _store(info):
+            if info is not None:
+                if len(_source_info_cache) >= SOURCE_INFO_CACHE_SIZE:
+                    _source_info_cache.clear()
+                _source_info_cache[key] = info
+            return info
+
+        if not callable(callback):
+            return _store(self.identify(path))
+        self.identify(path, lambda info: callback(_store(info)))
+
+    def plan(self, info):
+        """
+        Drops chained operations that wouldn't change an image described by
+        info (an ImageInfo): resizes and constrains to the dimensions the image
+        already has, and full-size crops.  Resizes that shrink the image by at
+        least thumbnail_factor are switched to -thumbnail with
+        thumbnail_filter.  Filter names are left untouched.
+        """
+        if not info:
+            return
+
+        dims = (info.width, info.height)
+        i = 0
+        while i < len(self._ops):
+            name = self._ops[i][0]
+            noop = False
+            if name.startswith('resize_'):
+                (w, h, resize_type) = map(int, name.split('_')[1:4])
+                noop = dims == (w, h)
+                operation = self._ops[i][1]
+                if not noop and dims and self.thumbnail_factor and '-resize' in operation:
+                    # Fill (^) and forced (!) resizes are limited by the
+                    # smaller reduction, fits by the larger one.
+                    pick = max if resize_type == 1 else min
+                    factor = pick(dims[0] / float(w), dims[1] / float(h))
+                    if factor >= self.thumbnail_factor:
+                        size = operation[operation.index('-resize') + 1]
+                        self._replace_op(i, self._resize_op(size, True, self.thumbnail_filter))
+                if resize_type == 0 or (dims and dims[0] * h == dims[1] * w):
+                    dims = (w, h)
+                else:
+                    dims = None
+            elif name.startswith('constrain_'):
+                (w, h) = map(int, name.split('_')[1:3])
+                noop = dims == (w, h)
+                dims = (w, h)
+            elif name.startswith('crop_'):
+                geometry = _parse_geometry(name.split('_', 2)[2])
+                noop = geometry is not None and dims is not None and \
+                    geometry == (dims[0], dims[1], 0, 0)
+                if not noop:
+                    dims = None
+            elif name.startswith('extent_'):
+                dims = tuple(map(int, name.split('_')[1:3]))
+            elif not name.startswith(('overlay_', 'text_', 'normalize', 'equalize',
+                                      'contrast_stretch_', 'brightness_contrast_',
+                                      'blur_', 'set_quality_', 'rgb555_dither')):
+                dims = None
+
+            if noop:
+                self._replace_op(i, None)
+            else:
+                i += 1
+
+    def is_identity(self, info):
+        """
+        Returns true if running the chain against an image described by info
+        would only re-encode it into the format it's already in.  JPEGs with
+        profiles (EXIF, ICC...) or a comment aren't, format_options() strips
+        them.
+        """
+        if not info or info.format != self.format or info.depth != 8:
+            return False
+        if self.uses_pixel_stage():
+            return False
+
+        options = [o for o in self.options if o != '+repage']
+        if self.format == self.JPEG:
+            if info.colorspace != 'sRGB' or self.comment != '\'\'' or \
+                    info.profiles or info.comment:
+                return False
+            if options[0:2] == ['-colorspace', 'sRGB']:
+                options = options[2:]
+        elif self.format != self.PNG:
+            return False
+
+        return len(options) == 0
+
+    def limit_memory(self, info, memory_limit, map_limit):
+        """
+        Large-image mode for a local source described by info (an ImageInfo)
+        that is too big to decode in memory.  Limits convert's pixel cache to
+        memory_limit of memory and map_limit of memory-mapped disk (e.g.
+        "256MiB"), beyond which it's kept on disk and processed in tiles.  A
+        leading crop is done while reading the source instead, and JPEGs that
+        are resized first are decoded at a reduced size.  Filter names are
+        left untouched.
+        """
+        self.input_options = ['-limit', 'memory', memory_limit, '-limit', 'map', map_limit]
+        if not self._ops:
+            return
+
+        name = self._ops[0][0]
+        if name.startswith('crop_'):
+            region = self._crop_region(name, info)
+            if region:
+                self.read_region = "[%dx%d+%d+%d]" % region
+                self._replace_op(0, None)
+        elif name.startswith('resize_') and info.format == self.JPEG:
+            # The JPEG decoder scales down by powers of two while staying
+            # over this size; leave it twice the target for the resize.
+            (w, h) = map(int, name.split('_')[1:3])
+            self.input_options += ['-define', 'jpeg:size=%dx%d' % (w * 2, h * 2)]
+
+    def _crop_region(self, name, info):
+        """
+        Private helper.  Returns the (w, h, x, y) region of an image described
+        by info that the crop_ operation called name keeps, measured from the
+        top left, or None if it isn't entirely within the image.
+        """
+        (g, geometry) = name.split('_', 2)[1:3]
+        geometry = _parse_geometry(geometry)
+        if not geometry:
+            return None
+
+        (w, h, x, y) = geometry
+        if 'West' in g:
+            left = x
+        elif 'East' in g:
+            left = info.width - w - x
+        else:
+            left = (info.width - w) / 2 + x
+        if 'North' in g:
+            top = y
+        elif 'South' in g:
+            top = info.height - h - y
+        else:
+            top = (info.height - h) / 2 + y
+
+        if left < 0 or top < 0 or left + w > info.width or top + h > info.height:
+            return None
+        return (w, h, left, top)
+
+    def estimate_cost(self, info=None):
+        """
+        Returns a rough, relative cost of running the chain: the megapixels
+        of the output, times OP_COSTS for each expensive operation.  info (an
+        ImageInfo) gives the source size; without it, or once an operation
+        makes the size unknown, DEFAULT_PIXELS is assumed.  Sprite sheets
+        cost that per tile.
+        """
+        dims = (info.width, info.height) if info else None
+        weight = 1.0
+        for (name, _) in self._ops:
+            fields = name.split('_')
+            if name.startswith(('resize_', 'constrain_', 'extent_')):
+                dims = (int(fields[1]), int(fields[2]))
+            elif name.startswith('splice_') and dims:
+                dims = (dims[0] + int(fields[1]), dims[1] + int(fields[2]))
+            elif name.startswith('reflect_') and dims:
+                dims = (dims[0], dims[1] + int(float(fields[1])))
+            elif name.startswith('crop_'):
+                geometry = _parse_geometry(fields[2])
+                dims = geometry[0:2] if geometry else None
+
+            for (prefix, cost) in self.OP_COSTS.iteritems():
+                if name.startswith(prefix):
+                    weight *= cost
+
+        pixels = dims[0] * dims[1] if dims else self.DEFAULT_PIXELS
+        return weight * pixels * self.tiles / 1000000.0
+
     def get_mime_type(self):
         """
         Return the mime type for the current set of options.
@@ -441,13 +1092,30 @@ class ImageMagick(object):
         """
         self.comment = '\'' + comment + '\''
 
+    def uses_pixel_stage(self):
+        """
+        Returns True if convert's output is decoded and passed through
+        pixel_stage, which only PNGs are.
+        """
+        return self.pixel_stage is not None and self.format == self.PNG
+
+    def apply_pixel_stage(self, output):
+        """
+        Returns convert's output, decoded pixels in PAM format, run through
+        pixel_stage and encoded as a PNG.
+        """
+        return dither.write_png(self.pixel_stage(dither.read_pam(output)))
+
     def format_options(self):
         """
         Returns standard ImageMagick options for converting into this instance's format.
         """
         opts = []
 
-        if self.format == self.PNG:
+        if self.uses_pixel_stage():
+            # Raw RGBA pixels for pixel_stage, which encodes the PNG
+            opts.extend(["-depth", "8", "-type", "TrueColorAlpha", "pam:-"])
+        elif self.format == self.PNG:
             # -quality 95
             #  9 = zlib compression level 9
             #  5 = adaptive filtering
@@ -485,16 +1153,52 @@ class ImageMagick(object):
         return opts
 
     def convert_cmdline(self, path, stdin=False):
-        command = [
-            'convert' if not self.convert_path else self.convert_path,
-            '-' if stdin else path
-        ]
-        command.extend(self.options)
-        command.append('-quiet')
-        command.extend(self.format_options())
+        command = ['convert' if not self.convert_path else self.convert_path]
+        command.extend(self.input_options)
+        if stdin:
+            command.append('-')
+        elif path is not None:
+            command.append(path + (self.read_region or ''))
+        options = self.options + ['-quiet'] + self.format_options()
+        if self.optimize:
+            options = _optimize_options(options)
+        command.extend(options)
         return command
 
-    def convert(self, path, chunk_ready=None, complete=None, error=None):
+    def cancel(self):
+        """
+        Kills the running asynchronous conversion, if any.  Only its cancelled
+        callback is called afterwards.  Returns True if a conversion was
+        running.
+        """
+        if not self._cancel:
+            return False
+        self._cancel()
+        return True
+
+    def convert_stream(self, path):
+        """
+        Starts converting the image at the given path and returns a
+        ConversionStream to read the output from.
+        """
+        return ConversionStream(self, path)
+
+    @gen.coroutine
+    def convert_async(self, path):
+        """
+        Coroutine version of convert: resolves to the processed image as a
+        string.  Raises ConversionError if the conversion fails.
+        """
+        stream = self.convert_stream(path)
+        chunks = []
+        while True:
+            chunk = yield stream.read_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+        raise gen.Return(''.join(chunks))
+
+    def convert(self, path, chunk_ready=None, complete=None, error=None, cancelled=None):
         """
         Converts the image at the given path according to the filter chain.  If
         write_chunk, close, and error are provided, the image is provided
@@ -505,11 +1209,19 @@ class ImageMagick(object):
            no minimum or maximum size.
          - complete(): Called when the processing has completed.
          - error(): Called if there was an error processing the image.
+           failed_process tells which step failed: "curl" (fetching a
+           remote source), "convert" or "pixel_stage".
+         - cancelled(): Optional, called if the conversion is killed through
+           cancel().
         """
+        self.failed_process = None
+
+        if self.text_layers:
+            self.render_text_layers()
 
         source = None
-        if is_remote(path):
-            source = Popen(
+        if path is not None and is_remote(path):
+            source = _Process(
                 ['curl' if not self.curl_path else self.curl_path, '-sfL', path],
                 stdout=PIPE,
                 close_fds=True)
@@ -518,6 +1230,7 @@ class ImageMagick(object):
             # since the process won't kick off until we actually start reading
             # from it.
             if _proc_failed(source):
+                self.failed_process = "curl"
                 if callable(error):
                     error()
                 return
@@ -525,18 +1238,33 @@ class ImageMagick(object):
         command = self.convert_cmdline(path, source is not None)
         logger.debug("CONVERT %s (opts: %s) COMMAND %s" % (path, repr(self.options), command))
 
-        convert = Popen(command,
-                        stdin=source.stdout if source else None,
-                        stdout=PIPE,
-                        stderr=PIPE,
-                        close_fds=True)
+        convert = _Process(command,
+                           stdin=source.stdout if source else None,
+                           stdout=PIPE,
+                           stderr=PIPE,
+                           close_fds=True)
 
         if source:
             source.stdout.close()
 
+        if self.uses_pixel_stage() and all(map(callable, [chunk_ready, complete, error])):
+            (chunk_ready, complete) = self._pixel_stage_callbacks(chunk_ready, complete, error, cancelled)
+
+        def _failed_step():
+            # curl's failure usually fails convert too, so look at it first.
+            # Call before _cleanup(), which kills curl.
+            return "curl" if source and _proc_failed(source) else "convert"
+
+        def _record_usage():
+            self.rusage = convert.rusage
+            if self.rusage:
+                logger.debug("CONVERT %s used %.3fs user %.3fs sys, %dKB max RSS" % (
+                    path, self.rusage.ru_utime, self.rusage.ru_stime, self.rusage.ru_maxrss))
+
         if all(map(callable, [chunk_ready, complete, error])):
             # Non-blocking case
             def _cleanup(fd):
+                self._cancel = None
                 self.ioloop.remove_handler(fd)
 
                 if source:
@@ -545,40 +1273,57 @@ class ImageMagick(object):
 
             def _on_read(fd, events):
                 if (source and _proc_failed(source)) or _proc_failed(convert):
+                    self.failed_process = _failed_step()
                     _cleanup(fd)
                     error()
 
                 else:
-                    chunk = convert.stdout.read()
-                    if len(chunk) == 0 or convert.returncode == 0:
+                    (chunks, eof) = _read_chunks(fd, READS_PER_EVENT)
+                    if eof or convert.returncode == 0:
 
                         # Block to ensure we get the whole output, without this
                         # we generate corrupted images
-                        _make_blocking(convert.stdout.fileno())
-                        chunk += convert.stdout.read()
+                        if not eof:
+                            _make_blocking(fd)
+                            chunks.extend(_read_chunks(fd)[0])
                         convert.stdout.close()
                         convert.wait()
-                        if len(chunk) > 0:
+                        _record_usage()
+                        for chunk in chunks:
                             chunk_ready(chunk)
-                            chunk = ""
 
+                        if convert.poll() != 0:
+                            self.failed_process = _failed_step()
                         _cleanup(fd)
                         if convert.poll() == 0:
                             complete()
                         else:
                             error()
                     else:
-                        chunk_ready(chunk)
+                        for chunk in chunks:
+                            chunk_ready(chunk)
 
             def _on_error_read(fd, events):
                 buf = convert.stderr.read()
                 if not buf:
+                    self.ioloop.remove_handler(fd)
                     convert.stderr.close()
                 else:
                     logger.error("Conversion error: %s" % buf)
 
+            def _cancel():
+                logger.debug("CANCEL %s" % path)
+                if not convert.stderr.closed:
+                    self.ioloop.remove_handler(err_fd)
+                _cleanup(fd)
+                convert.stdout.close()
+                convert.stderr.close()
+                if callable(cancelled):
+                    cancelled()
+
             # Make output non-blocking
             fd = convert.stdout.fileno()
+            err_fd = convert.stderr.fileno()
             self.ioloop.add_handler(
                 _non_blocking_fileno(convert.stdout),
                 _on_read,
@@ -587,10 +1332,134 @@ class ImageMagick(object):
                 _non_blocking_fileno(convert.stderr),
                 _on_error_read,
                 IOLoop.READ)
+            self._cancel = _cancel
 
         else:
             # Blocking case (if no handlers are passed)
             output = convert.communicate()[0]
+            _record_usage()
             if (source and source.returncode != 0) or convert.returncode != 0:
                 return None
+            if self.uses_pixel_stage():
+                return self.apply_pixel_stage(output)
             return output
+
+    def _pixel_stage_callbacks(self, chunk_ready, complete, error, cancelled):
+        """
+        Returns chunk_ready and complete callbacks collecting convert's output
+        and running it through apply_pixel_stage() in a thread, off the
+        IOLoop, before passing the result on to the given callbacks.
+        """
+        chunks = []
+        state = {"cancelled": False}
+
+        def _deliver(output):
+            self._cancel = None
+            if state["cancelled"]:
+                return
+            if output is None:
+                self.failed_process = "pixel_stage"
+                return error()
+            chunk_ready(output)
+            complete()
+
+        def _run():
+            try:
+                output = self.apply_pixel_stage("".join(chunks))
+            except Exception:
+                logger.exception("Pixel stage failed")
+                output = None
+            self.ioloop.add_callback(_deliver, output)
+
+        def _cancel():
+            state["cancelled"] = True
+            self._cancel = None
+            if callable(cancelled):
+                cancelled()
+
+        def _complete():
+            self._cancel = _cancel
+            worker = Thread(target=_run, name="ectyper-pixel-stage")
+            worker.daemon = True
+            worker.start()
+
+        return (chunks.append, _complete)
+
+
+class ConversionStream(object):
+    """
+    Output of a running asynchronous conversion, for use from coroutines:
+
+        stream = magick.convert_stream(path)
+        while True:
+            chunk = yield stream.read_chunk()
+            if chunk is None:
+                break
+            ...
+
+    Cancelling the stream (or the ImageMagick instance) kills the conversion.
+    """
+
+    def __init__(self, magick, path):
+        self.magick = magick
+        self.path = path
+        self._chunks = deque()
+        self._waiter = None
+        self._done = False
+        self._error = None
+        magick.convert(path,
+                       chunk_ready=self._on_chunk_ready,
+                       complete=self._on_complete,
+                       error=self._on_error,
+                       cancelled=self._on_cancelled)
+
+    def read_chunk(self):
+        """
+        Returns a Future resolving to the next chunk of output, or to None once
+        the whole image has been read.  The Future fails with ConversionError
+        if the conversion failed, ConversionCancelled if it was cancelled.
+        """
+        assert self._waiter is None, "read_chunk() is already pending"
+        future = Future()
+        if not self._resolve(future):
+            self._waiter = future
+        return future
+
+    def cancel(self):
+        """
+        Kills the conversion.  Pending and later reads fail with
+        ConversionCancelled.
+        """
+        self.magick.cancel()
+
+    def _resolve(self, future):
+        if self._chunks:
+            future.set_result(self._chunks.popleft())
+        elif self._error:
+            future.set_exception(self._error)
+        elif self._done:
+            future.set_result(None)
+        else:
+            return False
+        return True
+
+    def _wake(self):
+        if self._waiter and self._resolve(self._waiter):
+            self._waiter = None
+
+    def _on_chunk_ready(self, chunk):
+        self._chunks.append(chunk)
+        self._wake()
+
+    def _on_complete(self):
+        self._done = True
+        self._wake()
+
+    def _on_error(self):
+        self._error = ConversionError("Conversion failed for %s" % self.path)
+        self._wake()
+
+    def _on_cancelled(self):
+        self._chunks.clear()
+        self._error = ConversionCancelled("Conversion cancelled for %s" % self.path)
+        self._wake()
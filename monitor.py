@@ -0,0 +1,130 @@
+"""
+Finding what holds up the IOLoop.  LoopLagMonitor logs the stack of the
+IOLoop's thread whenever a callback blocks it for too long; sample_stacks()
+profiles running threads by sampling their stacks, for flame graphs (see
+ectyper.handlers.ProfileHandler).
+"""
+import logging
+import os.path
+import sys
+from thread import get_ident
+from threading import Event, Lock, Thread
+from time import sleep, time
+import traceback
+
+from ectyper import stats
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+__all__ = ["LoopLagMonitor", "sample_stacks", "format_collapsed"]
+
+logger = logging.getLogger("ectyper")
+
+# Held while sample_stacks() runs, one profile at a time
+_sampling = Lock()
+
+
+class LoopLagMonitor(object):
+    """
+    Watches an IOLoop from a background thread.  The IOLoop records a
+    heartbeat every interval seconds; once a heartbeat is more than
+    threshold seconds late, the stack of the IOLoop's thread, i.e. the
+    callback blocking it, is logged.  The loop_blocked counter and the
+    loop_lag_ms_max gauge report on the stalls.  Start it from the IOLoop's
+    thread:
+
+        LoopLagMonitor(threshold=0.1).start()
+    """
+
+    def __init__(self, threshold=0.1, interval=None, ioloop=None):
+        self.threshold = threshold
+        self.interval = interval or threshold / 2
+        self.ioloop = ioloop or IOLoop.current()
+        self.beat = None
+        self.thread_id = None
+        self.reported = None
+        self._stopped = Event()
+        self._heartbeat = None
+
+    def start(self):
+        self._stopped.clear()
+        self._heartbeat = PeriodicCallback(self.on_heartbeat, self.interval * 1000, self.ioloop)
+        self._heartbeat.start()
+        self.ioloop.add_callback(self.on_heartbeat)
+        watcher = Thread(target=self._watch, name="ectyper-loop-lag")
+        watcher.daemon = True
+        watcher.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat:
+            self._heartbeat.stop()
+            self._heartbeat = None
+
+    def on_heartbeat(self):
+        now = time()
+        if self.beat is not None:
+            lag = now - self.beat - self.interval
+            if lag > self.threshold:
+                stats.set_max("loop_lag_ms_max", int(lag * 1000))
+        self.thread_id = get_ident()
+        self.beat = now
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            beat = self.beat
+            if beat is None or beat == self.reported:
+                continue
+            blocked = time() - beat - self.interval
+            if blocked <= self.threshold:
+                continue
+
+            # Once per stall
+            self.reported = beat
+            stats.incr("loop_blocked")
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(unknown)\n"
+            logger.warning("IOLoop blocked for over %dms in:\n%s" % (blocked * 1000, stack))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def sample_stacks(duration, interval=0.005, thread_ids=None):
+    """
+    Samples the stacks of the threads in thread_ids (default every thread
+    but the caller's) every interval seconds for duration seconds, and
+    returns how often each stack was seen, keyed on the stack in collapsed
+    form: "outermost;...;innermost".  Blocks for duration, so call it from
+    its own thread.  Returns None if another profile is running.
+    """
+    if not _sampling.acquire(False):
+        return None
+    try:
+        me = get_ident()
+        counts = {}
+        end = time() + duration
+        while time() < end:
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id == me or (thread_ids and thread_id not in thread_ids):
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack = ";".join(reversed(names))
+                counts[stack] = counts.get(stack, 0) + 1
+            sleep(interval)
+        return counts
+    finally:
+        _sampling.release()
+
+
+def format_collapsed(counts):
+    """
+    Returns sample_stacks() counts as collapsed stack lines, "stack count",
+    as read by flamegraph.pl.
+    """
+    return "".join("%s %d\n" % (stack, count)
+                   for (stack, count) in sorted(counts.iteritems(), key=lambda item: -item[1]))
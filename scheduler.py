@@ -0,0 +1,118 @@
+"""
+Admission control for conversions.  Requests are sorted into priority
+classes, each with its own concurrency limit and queue, so a burst of
+expensive conversions only queues behind itself and cheap requests keep
+their own slots.
+"""
+from collections import deque
+import logging
+
+from ectyper import stats
+from tornado.ioloop import IOLoop
+
+__all__ = ["Scheduler"]
+
+logger = logging.getLogger("ectyper")
+
+
+class Admission(object):
+    """
+    A request for a slot in a priority class, as returned by
+    Scheduler.admit().
+    """
+
+    def __init__(self, priority, callback, cancelled=None):
+        self.priority = priority
+        self.callback = callback
+        self.cancelled = cancelled
+        self.admitted = False
+        self.released = False
+
+
+class Scheduler(object):
+    """
+    Admits work by priority class.  limits maps each class to the number of
+    conversions of that class that may run at once; classes not listed get
+    default_limit.  Work over the limit waits in its class's queue, first in
+    first out.  Share one Scheduler between handlers, e.g.:
+
+        SCHEDULER = Scheduler({"cheap": 16, "expensive": 2})
+
+    Only use a Scheduler from its IOLoop's thread.
+    """
+
+    def __init__(self, limits=None, default_limit=4, ioloop=None):
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.running = {}
+        self.queues = {}
+        self.ioloop = ioloop
+
+    def limit(self, priority):
+        """
+        Returns the concurrency limit of the priority class.
+        """
+        return self.limits.get(priority, self.default_limit)
+
+    def admit(self, priority, callback, cancelled=None):
+        """
+        Calls callback once work of the priority class may start, right away
+        if the class has a free slot.  Returns an Admission, which must be
+        passed to release() when the work is done or no longer wanted.
+        cancelled (if given) is called instead of callback if the admission
+        is released before the work started.
+        """
+        admission = Admission(priority, callback, cancelled)
+        if self.running.get(priority, 0) < self.limit(priority):
+            self._start(admission)
+            callback()
+        else:
+            logger.debug("queueing %s conversion" % priority)
+            stats.incr("scheduler_queued_%s" % priority)
+            self.queues.setdefault(priority, deque()).append(admission)
+            self._update_gauges(priority)
+        return admission
+
+    def release(self, admission):
+        """
+        Frees the slot taken by admission, or drops it from its queue (and
+        calls its cancelled callback) if it hasn't been admitted yet.
+        Releasing twice does nothing.
+        """
+        if admission.released:
+            return
+        admission.released = True
+        priority = admission.priority
+        if not admission.admitted:
+            try:
+                self.queues[priority].remove(admission)
+            except (KeyError, ValueError):
+                pass
+            if admission.cancelled:
+                admission.cancelled()
+        else:
+            self.running[priority] -= 1
+            queue = self.queues.get(priority)
+            if queue and self.running[priority] < self.limit(priority):
+                waiting = queue.popleft()
+                self._start(waiting)
+                # Don't start the next conversion from within the callbacks
+                # of the one that just finished
+                (self.ioloop or IOLoop.current()).add_callback(self._run, waiting)
+        self._update_gauges(priority)
+
+    def _run(self, admission):
+        if not admission.released:
+            admission.callback()
+        elif admission.cancelled:
+            # Released while waiting for the IOLoop
+            admission.cancelled()
+
+    def _start(self, admission):
+        admission.admitted = True
+        self.running[admission.priority] = self.running.get(admission.priority, 0) + 1
+        self._update_gauges(admission.priority)
+
+    def _update_gauges(self, priority):
+        stats.set_gauge("scheduler_running_%s" % priority, self.running.get(priority, 0))
+        stats.set_gauge("scheduler_waiting_%s" % priority, len(self.queues.get(priority, ())))
@@ -0,0 +1,131 @@
+"""
+Pre-fork multi-process serving.  serve() forks workers that share one
+listening socket; InflightLocks lets them see each other's conversions so
+a derivative is rendered once per machine rather than once per worker.
+"""
+from errno import EEXIST, ENOENT, EPERM
+from hashlib import md5
+import logging
+import os
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
+
+from ectyper import stats
+from ectyper.monitor import LoopLagMonitor
+
+__all__ = ["serve", "InflightLocks"]
+
+logger = logging.getLogger("ectyper")
+
+
+def serve(application, port, address="", processes=0, lag_threshold=None,
+          stats_path=None, stats_interval=60, **kwargs):
+    """
+    Serves application on port from processes forked workers (0 starts one
+    per CPU) sharing the listening socket, and blocks.  Use it in place of
+    application.listen() and IOLoop.start(), without touching the IOLoop
+    before, since it can't be shared with the workers.  kwargs are passed
+    to HTTPServer.  With lag_threshold (seconds), each worker runs a
+    LoopLagMonitor.  With stats_path, each worker writes its stats (see
+    stats.dump) to stats_path.(worker number) every stats_interval seconds.
+
+    Workers are separate processes: stats, schedulers, in-process caches
+    and MemcacheStore connection pools are per worker, while the file cache
+    and the memcached servers behind a MemcacheStore are shared.  A
+    SegmentStore must only be written by one process.
+    """
+    sockets = bind_sockets(port, address)
+    task_id = fork_processes(processes)
+    logger.info("worker %d serving on port %d" % (os.getpid(), port))
+    server = HTTPServer(application, **kwargs)
+    server.add_sockets(sockets)
+    if lag_threshold:
+        LoopLagMonitor(lag_threshold).start()
+    if stats_path:
+        path = "%s.%d" % (stats_path, task_id)
+        PeriodicCallback(lambda: stats.dump(path), stats_interval * 1000).start()
+    IOLoop.current().start()
+
+
+class InflightLocks(object):
+    """
+    Lock files under path marking the keys being converted by the processes
+    of one machine.  Each lock holds the pid of its owner, so locks left
+    behind by dead processes are taken over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, md5(key).hexdigest() + ".lock")
+
+    def acquire(self, key):
+        """
+        Takes the lock for key.  Returns False if a live process holds it.
+        """
+        path = self._path(key)
+        for _ in xrange(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError, e:
+                if e.errno != EEXIST:
+                    raise
+                if self.held(key):
+                    return False
+                logger.debug("taking over stale lock %s" % path)
+                self._remove(path)
+                continue
+
+            try:
+                os.write(fd, str(os.getpid()))
+            finally:
+                os.close(fd)
+            return True
+        return False
+
+    def held(self, key):
+        """
+        Returns True if a live process holds the lock for key.
+        """
+        try:
+            fh = open(self._path(key))
+            try:
+                pid = fh.read().strip()
+            finally:
+                fh.close()
+        except IOError:
+            return False
+
+        # Being written by its owner
+        if not pid:
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ValueError:
+            return False
+        except OSError, e:
+            return e.errno == EPERM
+        return True
+
+    def release(self, key):
+        """
+        Releases the lock for key.
+        """
+        self._remove(self._path(key))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != ENOENT:
+                raise
@@ -0,0 +1,164 @@
+"""
+Process-wide counters and gauges for ectyper's handlers, and heavy hitter
+tables of their most frequent keys.  Values can be updated from any thread.
+"""
+from heapq import heappop, heappush
+import json
+import os
+from threading import Lock
+
+__all__ = ["incr", "set_gauge", "set_max", "get", "snapshot", "reset",
+           "TopK", "offer", "top", "top_snapshot", "dump"]
+
+_lock = Lock()
+_values = {}
+_tables = {}
+
+
+def incr(name, amount=1):
+    """
+    Adds amount to the counter called name.
+    """
+    with _lock:
+        _values[name] = _values.get(name, 0) + amount
+
+
+def set_gauge(name, value):
+    """
+    Sets the gauge called name to value.
+    """
+    with _lock:
+        _values[name] = value
+
+
+def set_max(name, value):
+    """
+    Raises the gauge called name to value, if value is larger.
+    """
+    with _lock:
+        _values[name] = max(_values.get(name, value), value)
+
+
+def get(name, default=0):
+    """
+    Returns the current value of the counter or gauge called name.
+    """
+    with _lock:
+        return _values.get(name, default)
+
+
+def snapshot():
+    """
+    Returns a copy of all counters and gauges as a dict.
+    """
+    with _lock:
+        return dict(_values)
+
+
+def reset():
+    """
+    Clears all counters and gauges.
+    """
+    with _lock:
+        _values.clear()
+        _tables.clear()
+
+
+class TopK(object):
+    """
+    Approximate counts of the capacity most frequent items of a stream, in
+    constant memory (the space-saving algorithm).  An item missing from the
+    table replaces the least counted one and inherits its count, which is
+    kept as the item's error: its true count lies between count - error and
+    count.  Any item seen more than 1/capacity of the time is in the table.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        # One (count, item) entry per item, possibly below its current count
+        self.heap = []
+        self.lock = Lock()
+
+    def offer(self, item, count=1):
+        """
+        Counts count occurrences of item.
+        """
+        with self.lock:
+            entry = self.counts.get(item)
+            if entry is not None:
+                entry[0] += count
+                return
+            error = 0
+            if len(self.counts) >= self.capacity:
+                while True:
+                    (low, evicted) = heappop(self.heap)
+                    current = self.counts[evicted][0]
+                    if current == low:
+                        break
+                    heappush(self.heap, (current, evicted))
+                del self.counts[evicted]
+                error = low
+            self.counts[item] = [error + count, error]
+            heappush(self.heap, (error + count, item))
+
+    def top(self, n=None):
+        """
+        Returns the n (default all) most frequent items as (item, count,
+        error) tuples, most frequent first.
+        """
+        with self.lock:
+            items = [(item, count, error) for (item, (count, error)) in self.counts.iteritems()]
+        items.sort(key=lambda (item, count, error): -count)
+        return items[:n] if n else items
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            del self.heap[:]
+
+
+def offer(name, item, count=1, capacity=1000):
+    """
+    Counts count occurrences of item in the heavy hitter table called name,
+    which keeps the capacity most frequent items.
+    """
+    with _lock:
+        table = _tables.get(name)
+        if table is None:
+            table = _tables[name] = TopK(capacity)
+    table.offer(item, count)
+
+
+def top(name, n=None):
+    """
+    Returns the n (default all) most frequent items of the table called name
+    as (item, count, error) tuples, most frequent first.
+    """
+    with _lock:
+        table = _tables.get(name)
+    return table.top(n) if table else []
+
+
+def top_snapshot(n=None):
+    """
+    Returns the n most frequent items of every table, as a dict of lists.
+    """
+    with _lock:
+        names = list(_tables)
+    return dict((name, top(name, n)) for name in names)
+
+
+def dump(path, n=None):
+    """
+    Writes the counters and gauges ("values") and the n most frequent items
+    of every table ("top") to path as JSON, replacing it atomically.
+    """
+    data = {"values": snapshot(), "top": top_snapshot(n)}
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    fh = open(tmp, "w")
+    try:
+        json.dump(data, fh)
+    finally:
+        fh.close()
+    os.rename(tmp, path)